@@ -1,66 +1,288 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-import google.generativeai as genai
+import asyncio
+import contextlib
 import os
 from dotenv import load_dotenv
+from utils.cache import TTLCache
+from utils.chat_history import ChatHistoryDB
+from utils.knowledge_index import format_snippet
+from utils.llm import CHAT_MODEL, error_message, get_gateway
+from utils.metrics import get_meter
+from utils.ratelimit import QueueFull, QueueNotice, get_limiter
+from utils.text import MESSAGE_LIMIT
 
 # .envを読み込む
 load_dotenv()
 
+# 会話セッションの保持設定
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "200"))      # 同時に保持する人数
+CHAT_SESSION_TTL = int(os.getenv("CHAT_SESSION_TTL", "3600"))       # 放置で破棄するまでの秒数
+CHAT_MAX_HISTORY = int(os.getenv("CHAT_MAX_HISTORY", "20"))         # 要約せずに残しておく往復数の上限 (超えた分は予算内でも要約する)
+CHAT_TOKEN_BUDGET = int(os.getenv("CHAT_TOKEN_BUDGET", "2000"))     # 毎ターン送る履歴のトークン目安
+CHAT_SUMMARY_MAX_CHARS = 1000                                        # 要約の最大文字数
+
+# ストリーミング返信の設定
+STREAM_EDIT_INTERVAL = 1.2    # メッセージを編集する最短間隔 (秒)。Discordのレート制限に引っかからない程度
+
+# ------------------------------------------------------------------
+# 履歴のトークン予算
+# ------------------------------------------------------------------
+def estimate_tokens(text):
+    # APIで数えると1往復増えるので概算する (日本語は1文字≒1トークン、英数字は4文字≒1トークン)
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+def split_window(history, budget=CHAT_TOKEN_BUDGET):
+    # 新しい往復から順に予算に収まる分だけ残し、(はみ出した古い分, 送る分) に分ける
+    used = 0
+    cut = len(history)
+    for i in range(len(history) - 2, -1, -2):
+        cost = estimate_tokens(history[i]["text"]) + estimate_tokens(history[i + 1]["text"])
+        if used + cost > budget: break
+        used += cost
+        cut = i
+    return history[:cut], history[cut:]
+
+def summarize_count(history, budget=CHAT_TOKEN_BUDGET, max_history=CHAT_MAX_HISTORY):
+    # 要約に回す先頭の件数。予算からはみ出した分と、往復数の上限を超えた分の多い方
+    older, _ = split_window(history, budget)
+    return max(len(older), len(history) - max_history * 2, 0)
+
+def compact_count(history):
+    # 要約するときは予算・往復数の半分まで畳み込む (毎ターン少しずつ要約し直さず、数ターンに1回で済むように)
+    return summarize_count(history, CHAT_TOKEN_BUDGET // 2, CHAT_MAX_HISTORY // 2)
+
+def build_contents(state, message):
+    _, window = split_window(state["history"])
+    contents = []
+    if state["summary"]:
+        contents.append({"role": "user", "parts": [f"（これまでの会話の要約）\n{state['summary']}"]})
+        contents.append({"role": "model", "parts": ["うん、覚えてるよ。"]})
+    contents += [{"role": h["role"], "parts": [h["text"]]} for h in window]
+    contents.append({"role": "user", "parts": [message]})
+    return contents
+
+# ------------------------------------------------------------------
+# 生成途中の返信を少しずつ表示する
+# ------------------------------------------------------------------
+class StreamingReply:
+    def __init__(self, interaction, header, interval=STREAM_EDIT_INTERVAL, limit=MESSAGE_LIMIT):
+        self.interaction = interaction
+        self.interval = interval
+        self.limit = limit
+        self.pages = [header]   # メッセージごとの本文
+        self.sent = []          # 送信済みの WebhookMessage
+        self.sent_text = []     # 最後に送った本文 (同じ内容での編集を避ける)
+        self.last_flush = 0.0
+
+    def _append(self, text):
+        self.pages[-1] += text
+        # 上限を超えたら改行の位置で区切って次のメッセージに回す
+        while len(self.pages[-1]) > self.limit:
+            page = self.pages[-1]
+            cut = page.rfind("\n", 0, self.limit)
+            if cut <= 0: cut = self.limit
+            self.pages[-1] = page[:cut]
+            self.pages.append(page[cut:].lstrip("\n"))
+
+    async def feed(self, text):
+        self._append(text)
+        loop = asyncio.get_running_loop()
+        if loop.time() - self.last_flush >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        self.last_flush = asyncio.get_running_loop().time()
+        for i, page in enumerate(self.pages):
+            if not page.strip(): continue
+            if i >= len(self.sent):
+                msg = await self.interaction.followup.send(page, ephemeral=True, wait=True)
+                self.sent.append(msg)
+                self.sent_text.append(page)
+            elif self.sent_text[i] != page:
+                await self.sent[i].edit(content=page)
+                self.sent_text[i] = page
+
+# ------------------------------------------------------------------
+# 会話セッションの保管庫 (LRU + 放置TTL + 履歴上限 + SQLite永続化)
+# ------------------------------------------------------------------
+class SessionStore:
+    def __init__(self, db, max_sessions=CHAT_MAX_SESSIONS, idle_ttl=CHAT_SESSION_TTL):
+        self.db = db
+        # メモリ上には最近使った人の状態だけを置く。毎ターン保存しているので追い出しても失われない
+        self.cache = TTLCache(max_entries=max_sessions, ttl=idle_ttl, sliding=True)
+
+    async def get(self, user_id):
+        state = self.cache.get(user_id)
+        if state is None:
+            # 次に /chat したときに初めてDBから読み込む
+            state = await asyncio.to_thread(self.db.load, user_id)
+            self.cache.set(user_id, state)
+        return state
+
+    async def save(self, user_id, state):
+        # 履歴は要約に畳み込んだ分だけを Chat.compact が落とす (要約していない往復はここでは捨てない)
+        if state.get("discarded"): return
+        self.cache.set(user_id, state)
+        await asyncio.to_thread(self.db.save, user_id, state)
+
+    async def reset(self, user_id):
+        state = self.cache.pop(user_id)
+        if state is not None:
+            # 要約中のタスクが古い状態を書き戻さないようにする
+            state["discarded"] = True
+        await asyncio.to_thread(self.db.delete, user_id)
+
+    def stats(self):
+        return self.cache.stats()
+
 class Chat(commands.Cog):
-    def __init__(self, bot):
+    def __init__(self, bot, llm=None):
         self.bot = bot
+        # Geminiの呼び出しは共通のゲートウェイ経由 (同時実行数・タイムアウト・再試行・遮断を管理)
+        self.llm = llm or get_gateway()
+        # 1人が連投してGeminiの枠を使い切らないよう、/search と共通の制限をかける
+        self.limiter = get_limiter()
+        self.meter = get_meter()
+        self.sessions = SessionStore(ChatHistoryDB())
+        self.compacting = {}  # user_id -> 要約タスク
+        self.turns = {}       # user_id -> [ロック, 使っている数] (同じ人の /chat と要約を1件ずつにする)
+
+    async def cog_unload(self):
+        self.sessions.db.close()
+
+    async def with_knowledge(self, guild_id, message):
+        # 登録済みのマクロやメモ (そのサーバーのもの) に触れていたら、その内容を添えて送る (履歴には元の発言だけを残す)
+        knowledge = self.bot.get_cog("Knowledge")
+        if knowledge is None or guild_id is None: return message
+        hits = (await knowledge.shard(guild_id)).index.relevant(message)
+        if not hits: return message
+        snippets = "\n---\n".join(format_snippet(h) for h in hits)
+        return f"（参考: ギルドに登録されている情報）\n{snippets}\n\n{message}"
+
+    @contextlib.asynccontextmanager
+    async def turn(self, user_id):
+        entry = self.turns.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0: self.turns.pop(user_id, None)
+
+    async def compact(self, user_id):
         try:
-            api_key = os.getenv("GEMINI_API_KEY")
-            if not api_key:
-                print("⚠️ 警告: GEMINI_API_KEY が見つかりません！.envを確認してください。")
-            else:
-                genai.configure(api_key=api_key)
-                # ★修正点: エラーが出ない安定版の 'gemini-pro' に変更しました
-                self.model = genai.GenerativeModel('gemini-pro')
-                self.sessions = {}
+            # 要約している間に次の /chat が履歴を書き換えないよう、同じ人の /chat とは1件ずつにする。
+            # 本人が頼んだ呼び出しではないので、回数制限の枠 (その人のトークン) は使わない
+            async with self.turn(user_id):
+                await self._compact(user_id)
         except Exception as e:
-            print(f"Gemini Init Error: {e}")
+            print(f"❌ Chat Summary Error (User: {user_id}): {e}")
+        finally:
+            self.compacting.pop(user_id, None)
+
+    async def _compact(self, user_id):
+        # 待っている間に追い出し・読み込み直しがあってもよいように、状態はここで取り直す
+        state = await self.sessions.get(user_id)
+        count = compact_count(state["history"])
+        if count <= 0: return
+        older = state["history"][:count]
+        log = "\n".join(f"{'ユーザー' if h['role'] == 'user' else 'るーしー'}: {h['text']}" for h in older)
+        prompt = f"""
+        以下は「これまでの要約」と、その後の会話です。両方の内容をまとめて、新しい要約を{CHAT_SUMMARY_MAX_CHARS}文字以内で書いてください。
+        ユーザーの名前・好み・約束ごとなど、今後の会話で必要になりそうな事実を優先して残してください。
+
+        これまでの要約:
+        {state['summary'] or '(なし)'}
+
+        会話:
+        {log}
+        """
+        async with self.meter.track("chat_summary", user_id) as measure:
+            summary = await self.llm.generate(prompt, model=CHAT_MODEL, usage=measure.usage)
 
-    @app_commands.command(name="chat", description="【現在使えないと思います】るーしーと内緒話をします（履歴を覚えます・他人には見えません）")
+        # /forget されていたら書き戻さない
+        if state.get("discarded"): return
+        state["summary"] = summary.strip()[:CHAT_SUMMARY_MAX_CHARS]
+        # 要約に含めた往復だけを落とす
+        del state["history"][:count]
+        await self.sessions.save(user_id, state)
+
+    @app_commands.command(name="chat", description="るーしーと内緒話をします（履歴を覚えます・他人には見えません）")
     async def chat(self, interaction: discord.Interaction, message: str):
         await interaction.response.defer(ephemeral=True)
         user_id = interaction.user.id
 
+        notice = QueueNotice(interaction)
         try:
-            # セッション（会話の履歴）がなければ新しく作る
-            if user_id not in self.sessions:
-                self.sessions[user_id] = self.model.start_chat(history=[])
-            
-            chat_session = self.sessions[user_id]
-            
-            # メッセージを送信
-            response = chat_session.send_message(message)
-            
-            reply_text = response.text
-            # 文字数が多すぎたらカットする
-            if len(reply_text) > 1900:
-                reply_text = reply_text[:1900] + "..."
-
-            await interaction.followup.send(f"**あなた:** {message}\n\n**るーしー:**\n{reply_text}", ephemeral=True)
+            async with self.meter.track("chat", user_id) as measure:
+                # 同じ人の /chat は1件ずつ。混んでいたら順番待ちの位置を表示する
+                async with self.limiter.slot(user_id, on_queued=notice), self.turn(user_id):
+                    await notice.done()
+                    # 要約 + 予算内の直近の往復だけでセッションを組み立てる
+                    state = await self.sessions.get(user_id)
+                    contents = build_contents(state, await self.with_knowledge(interaction.guild_id, message))
+
+                    # メッセージを送信し、生成された分から順に表示する (非同期APIでイベントループを止めない)
+                    reply = StreamingReply(interaction, f"**あなた:** {message}\n\n**るーしー:**\n")
+                    reply_text = ""
+                    async for chunk in self.llm.stream(contents, model=CHAT_MODEL, usage=measure.usage):
+                        reply_text += chunk
+                        await reply.feed(chunk)
+                    await reply.flush()
+
+                    state["history"].append({"role": "user", "text": message})
+                    state["history"].append({"role": "model", "text": reply_text})
+                    await self.sessions.save(user_id, state)
+
+                    # 予算からはみ出した古い往復は、返信とは別に要約へ畳み込む (このターンを抜けてから始まる)
+                    if summarize_count(state["history"]) > 0 and user_id not in self.compacting:
+                        self.compacting[user_id] = asyncio.create_task(self.compact(user_id))
+
+        except QueueFull:
+            await interaction.followup.send("😵 いま混み合っていて受け付けられないみたい…少し待ってからもう一度試してね。", ephemeral=True)
 
         except Exception as e:
             # エラー内容をターミナルに表示
             print(f"❌ Chat Error (User: {interaction.user.name}): {e}")
-            
-            # エラーが起きたら履歴をリセットして、次は動くようにする
-            self.sessions[user_id] = self.model.start_chat(history=[])
-            
+
+            # 履歴は成功したときにしか書き換えないので、ここでは消さずにそのまま残す
+
             # ユーザーへのメッセージ
-            await interaction.followup.send(f"ごめん、ちょっとエラーが出ちゃったみたい。（モデルをgemini-proに変更して再試行してね）\nエラー内容: {e}", ephemeral=True)
+            await interaction.followup.send(error_message(e), ephemeral=True)
 
-    @app_commands.command(name="forget", description="【現在使えないと思います】会話の履歴をリセットします")
+    @app_commands.command(name="forget", description="会話の履歴をリセットします")
     async def forget(self, interaction: discord.Interaction):
-        # 強制的に履歴を空にする
-        if hasattr(self, 'model'):
-             self.sessions[interaction.user.id] = self.model.start_chat(history=[])
+        # 強制的に履歴を空にする (保存済みの履歴も消す)
+        await self.sessions.reset(interaction.user.id)
         await interaction.response.send_message("記憶をリセットしたよ！", ephemeral=True)
 
+    @app_commands.command(name="chatstats", description="会話セッションの保持状況を表示します (管理者用)")
+    @app_commands.default_permissions(administrator=True)
+    async def chat_stats(self, interaction: discord.Interaction):
+        st = self.sessions.stats()
+        msg = (
+            f"🧠 **会話セッション**\n"
+            f"保持中: {st['size']} / {st['max_entries']}\n"
+            f"ヒット: {st['hits']} / ミス: {st['misses']} (ヒット率 {st['hit_rate']:.0%})\n"
+            f"LRU追い出し: {st['evictions']} / 放置期限切れ: {st['expirations']}"
+        )
+        gw = self.llm.stats()
+        msg += (
+            f"\n\n🤖 **Gemini ({CHAT_MODEL})**\n"
+            f"呼び出し: {gw['calls']} / 再試行: {gw['retries']} / 失敗: {gw['failures']} / 遮断で拒否: {gw['rejected']}\n"
+            f"サーキットブレーカー: {gw['breaker']} (遮断 {gw['breaker_trips']} 回)"
+        )
+        rl = self.limiter.stats()
+        msg += (
+            f"\n\n🚦 **回数制限**\n"
+            f"通過: {rl['granted']} / 順番待ちあり: {rl['queued']} / 満員で拒否: {rl['rejected']}\n"
+            f"現在 待ち {rl['waiting']} 件・実行中 {rl['active']} 人"
+        )
+        await interaction.response.send_message(msg, ephemeral=True)
+
 async def setup(bot):
     await bot.add_cog(Chat(bot))
\ No newline at end of file
@@ -1,16 +1,79 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 from discord.ui import Button, View, Modal, TextInput
-import json
+import aiohttp
+import asyncio
+import hashlib
+import io
 import os
+import re
+import time
 import shutil
+import tarfile
+from urllib.parse import parse_qs, urlsplit
+from utils.image_optimize import get_optimizer
+from utils.image_store import ImageStore
+from utils.knowledge_archive import Progress, export_archive, import_archive
+from utils.knowledge_index import KIND_LABELS, make_snippet
+from utils.knowledge_shards import KnowledgeShard, ShardCache
+from utils.knowledge_store import KNOWLEDGE_HOME_GUILD, LEGACY_GUILD, KnowledgeStore, image_refs
+from utils.temp_janitor import TEMP_SWEEP_MINUTES, TempJanitor
 
 # データファイルのパス
 DATA_DIR = "data"
 IMAGES_DIR = os.path.join(DATA_DIR, "images")
 TEMP_DIR = os.path.join(DATA_DIR, "temp") # 一時保存用
-DATA_FILE = os.path.join(DATA_DIR, "knowledge.json")
+EXPORT_DIR = os.path.join(DATA_DIR, "exports") # /exportknowledge の保存先
+
+IMPORT_MAX_BYTES = 1024 * 1024 * 1024   # /importknowledge で受け付けるファイルの上限
+PROGRESS_INTERVAL = 3                   # 書き出し・取り込みの進み具合を更新する間隔 (秒)
+
+# /addcontent の添付画像の取り込み
+ATTACHMENT_CONCURRENCY = 4                  # 同時にダウンロードする数
+ATTACHMENT_MAX_BYTES = 10 * 1024 * 1024     # 1枚あたりの上限
+ATTACHMENT_TOTAL_BYTES = 40 * 1024 * 1024   # 1回の登録での合計の上限
+
+# 一度送った画像のURLを使い回すときの余裕 (期限切れ間近のURLは使わずに送り直す)
+CDN_URL_MARGIN = 3600
+
+def cdn_url_alive(url, margin=CDN_URL_MARGIN):
+    # DiscordのCDNのURLは ex=(16進数のUNIX時刻) まで有効
+    ex = parse_qs(urlsplit(url).query).get("ex")
+    if not ex: return False
+    try:
+        return int(ex[0], 16) - margin > time.time()
+    except ValueError:
+        return False
+
+def combine_memos(memos):
+    combined_text = ""
+    for i, m in enumerate(memos, 1):
+        combined_text += f"📝 **メモ{i}**:\n{m}\n\n"
+    return combined_text.strip()
+
+def sha256_all(datas):
+    # 画像が前と同じかどうかをハッシュで比べる。ブロッキングなのでスレッドから呼ぶ
+    return [hashlib.sha256(data).hexdigest() for data in datas]
+
+def parse_image_numbers(text):
+    # "2, 3" や "2 3" を {2, 3} にする。数字以外があれば None
+    numbers = set()
+    for part in re.split(r"[,、\s]+", text or ""):
+        if not part: continue
+        if not part.isdigit(): return None
+        numbers.add(int(part))
+    return numbers
+
+def mb(nbytes):
+    return f"{nbytes / 1024 / 1024:.1f}MB"
+
+def write_temp_files(folder, files):
+    # (ファイル名, データ) を一時フォルダに書き出す。ブロッキングなのでスレッドから呼ぶ
+    os.makedirs(folder, exist_ok=True)
+    for filename, data in files:
+        with open(os.path.join(folder, filename), "wb") as f:
+            f.write(data)
 
 # ------------------------------------------------------------------
 # コンテンツ追加時の確認ビュー
@@ -25,31 +88,87 @@ class AddContentConfirmView(View):
 
     @discord.ui.button(label="✅ これで保存する", style=discord.ButtonStyle.green)
     async def confirm(self, interaction: discord.Interaction, button: Button):
-        final_dir = os.path.join(IMAGES_DIR, self.name)
+        # 画像の最適化・取り込みは3秒を超えることがあるので、先にボタンへの応答を済ませる
+        await interaction.response.edit_message(content="⏳ 保存中…", view=None, attachments=[])
+        # 取り込み中に時間切れ (on_timeout) で一時フォルダが消されないよう、ビューはここで終える
+        self.stop()
+
+        # 画像はハッシュ単位の置き場に取り込む (同じ画像がすでにあればファイルは増えない)
+        images = []
+        if self.temp_folder:
+            images = await self.cog.ingest_uploads(self.temp_folder)
+            self.cog.pending_uploads.discard(self.temp_folder)
         
-        if os.path.exists(final_dir):
-            shutil.rmtree(final_dir)
-        
-        has_images = False
-        if self.temp_folder and os.path.exists(self.temp_folder):
-            shutil.move(self.temp_folder, final_dir)
-            has_images = True
-        
-        self.cog.data["contents"][self.name] = {
+        await self.cog.put_entry(interaction.guild_id, "contents", self.name, {
             "text": self.text_content,
-            "has_images": has_images
-        }
-        self.cog.save_data()
+            "has_images": bool(images),
+            "images": images
+        }, ingested=images)
 
-        await interaction.response.edit_message(content=f"✅ **「{self.name}」** を保存しました！", view=None, attachments=[])
+        await interaction.edit_original_response(content=f"✅ **「{self.name}」** を保存しました！")
 
     @discord.ui.button(label="❌ やめる", style=discord.ButtonStyle.red)
     async def cancel(self, interaction: discord.Interaction, button: Button):
-        if self.temp_folder and os.path.exists(self.temp_folder):
-            shutil.rmtree(self.temp_folder)
-            
+        await self.cog.release_temp(self.temp_folder)
         await interaction.response.edit_message(content="❌ 登録をキャンセルしました。", view=None, attachments=[])
 
+    async def on_timeout(self):
+        # ボタンが押されないまま時間切れになったら、一時フォルダはもう使わない
+        await self.cog.release_temp(self.temp_folder)
+
+# ------------------------------------------------------------------
+# コンテンツ更新時の確認ビュー
+# ------------------------------------------------------------------
+class ChangeContentConfirmView(View):
+    """plan は更新後の画像の並び。("keep", マニフェストの1件) か ("new", 一時フォルダのファイル名)。
+
+    変わっていない画像は今のハッシュをそのまま参照し、新しい画像だけを取り込む。
+    """
+
+    def __init__(self, cog, name, text_content, plan, temp_folder):
+        super().__init__(timeout=180)
+        self.cog = cog
+        self.name = name
+        self.text_content = text_content
+        self.plan = plan
+        self.temp_folder = temp_folder
+
+    @discord.ui.button(label="✅ これで更新する", style=discord.ButtonStyle.green)
+    async def confirm(self, interaction: discord.Interaction, button: Button):
+        # 画像の最適化・取り込みは3秒を超えることがあるので、先にボタンへの応答を済ませる
+        await interaction.response.edit_message(content="⏳ 保存中…", view=None, attachments=[])
+        # 取り込み中に時間切れ (on_timeout) で一時フォルダが消されないよう、ビューはここで終える
+        self.stop()
+
+        shard = await self.cog.shard(interaction.guild_id)
+        content_data = shard.data["contents"].get(self.name)
+        if content_data is None:
+            await self.cog.release_temp(self.temp_folder)
+            await interaction.edit_original_response(content="❌ エラー: データが見つかりません。")
+            return
+
+        images, ingested = await self.cog.apply_image_plan(self.plan, self.temp_folder)
+        self.cog.pending_uploads.discard(self.temp_folder)
+        value = {
+            "text": self.text_content,
+            "has_images": bool(images),
+            "images": images,
+        }
+        # 画像の並びが変わっていなければ、送信済みのURLはそのまま使える
+        if [img["hash"] for img in images] == [img["hash"] for img in content_data.get("images", [])] and content_data.get("image_urls"):
+            value["image_urls"] = content_data["image_urls"]
+        await self.cog.put_entry(interaction.guild_id, "contents", self.name, value, ingested=ingested)
+
+        await interaction.edit_original_response(content=f"🔄 **「{self.name}」** を更新しました！")
+
+    @discord.ui.button(label="❌ やめる", style=discord.ButtonStyle.red)
+    async def cancel(self, interaction: discord.Interaction, button: Button):
+        await self.cog.release_temp(self.temp_folder)
+        await interaction.response.edit_message(content="❌ 更新をキャンセルしました。", view=None, attachments=[])
+
+    async def on_timeout(self):
+        await self.cog.release_temp(self.temp_folder)
+
 # ------------------------------------------------------------------
 # 削除などの確認ビュー
 # ------------------------------------------------------------------
@@ -64,47 +183,44 @@ class ConfirmActionView(View):
     @discord.ui.button(label="はい (実行)", style=discord.ButtonStyle.green)
     async def confirm(self, interaction: discord.Interaction, button: Button):
         msg = ""
+        data = (await self.cog.shard(interaction.guild_id)).data
         # --- マクロ ---
         if self.action_type == "add_macro":
-            self.cog.data["macros"][self.name] = self.content
+            await self.cog.put_entry(interaction.guild_id, "macros", self.name, self.content)
             msg = f"✅ マクロ **「{self.name}」** を登録しました！"
         elif self.action_type == "del_macro":
-            if self.name in self.cog.data["macros"]:
-                del self.cog.data["macros"][self.name]
+            if self.name in data["macros"]:
+                await self.cog.delete_entry(interaction.guild_id, "macros", self.name)
                 msg = f"🗑️ マクロ **「{self.name}」** を削除しました。"
             else:
                 msg = "❌ エラー: データなし"
         elif self.action_type == "update_macro":
-            self.cog.data["macros"][self.name] = self.content
+            await self.cog.put_entry(interaction.guild_id, "macros", self.name, self.content)
             msg = f"🔄 マクロ **「{self.name}」** を更新しました！"
 
         # --- 攻略ボード ---
         elif self.action_type == "add_strat":
-            self.cog.data["strategies"][self.name] = self.content
+            await self.cog.put_entry(interaction.guild_id, "strategies", self.name, self.content)
             msg = f"✅ 攻略ボード **「{self.name}」** を登録しました！"
         elif self.action_type == "del_strat":
-            if self.name in self.cog.data["strategies"]:
-                del self.cog.data["strategies"][self.name]
+            if self.name in data["strategies"]:
+                await self.cog.delete_entry(interaction.guild_id, "strategies", self.name)
                 msg = f"🗑️ 攻略ボード **「{self.name}」** を削除しました。"
             else:
                 msg = "❌ エラー: データなし"
         elif self.action_type == "update_strat":
-            self.cog.data["strategies"][self.name] = self.content
+            await self.cog.put_entry(interaction.guild_id, "strategies", self.name, self.content)
             msg = f"🔄 攻略ボード **「{self.name}」** を更新しました！"
         
         # --- コンテンツ削除 ---
         elif self.action_type == "del_content":
-            target_dir = os.path.join(IMAGES_DIR, self.name)
-            if os.path.exists(target_dir):
-                shutil.rmtree(target_dir)
-            
-            if self.name in self.cog.data["contents"]:
-                del self.cog.data["contents"][self.name]
+            # 画像は参照数を減らし、どこからも使われなくなったものだけが消える
+            if self.name in data["contents"]:
+                await self.cog.delete_entry(interaction.guild_id, "contents", self.name)
                 msg = f"🗑️ コンテンツ **「{self.name}」** を完全に削除しました。"
             else:
                 msg = "❌ エラー: データが見つかりません。"
 
-        self.cog.save_data()
         await interaction.response.edit_message(content=msg, view=None, embed=None, attachments=[])
 
     @discord.ui.button(label="いいえ (キャンセル)", style=discord.ButtonStyle.red)
@@ -149,26 +265,145 @@ class UpdateModal(Modal):
 class Knowledge(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.data = self.load_data()
+        self.store = None
+        self.load_data()
+        # サーバーごとのデータは最初に使われたときに読み込む
+        self.shards = ShardCache(self.load_shard)
+        # 確認待ちの一時フォルダ (掃除の対象にしない)
+        self.pending_uploads = set()
+        self.janitor = TempJanitor(TEMP_DIR)
 
     def load_data(self):
-        for d in [DATA_DIR, IMAGES_DIR, TEMP_DIR]:
+        for d in [DATA_DIR, IMAGES_DIR, TEMP_DIR, EXPORT_DIR]:
             if not os.path.exists(d): os.makedirs(d)
 
-        if not os.path.exists(DATA_FILE):
-            init_data = {"macros": {}, "strategies": {}, "contents": {}}
-            with open(DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump(init_data, f)
-            return init_data
-        
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if "contents" not in data: data["contents"] = {}
-            return data
-
-    def save_data(self):
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(self.data, f, indent=4, ensure_ascii=False)
+        # 初回は knowledge.json を自動で取り込む
+        self.store = KnowledgeStore()
+        self.images = ImageStore(self.store)
+        self.optimizer = get_optimizer()
+        self.migrate_image_folders(self.store.load_guild(LEGACY_GUILD))
+        # 分ける前のデータは、決められたサーバーがあるときだけ自動で引き取る (無ければ /claimlegacyknowledge で)
+        if KNOWLEDGE_HOME_GUILD:
+            claimed = self.store.claim_legacy(KNOWLEDGE_HOME_GUILD)
+            if claimed: print(f"📦 サーバーごとに分ける前のデータ {claimed} 件を、サーバー {KNOWLEDGE_HOME_GUILD} のものにしました")
+
+    def load_shard(self, guild_id):
+        # スレッドで実行される (ShardCache)
+        return KnowledgeShard(guild_id, self.store.load_guild(guild_id))
+
+    async def shard(self, guild_id):
+        return await self.shards.get(guild_id)
+
+    def ingest_files(self, folder, filenames, variants):
+        # 一時フォルダの画像をハッシュ単位の置き場に移して、マニフェストを返す
+        images = []
+        for filename, optimized in zip(filenames, variants):
+            # 一時保存時に付けた並び順の番号 (01_ など) は元のファイル名から外す
+            original = re.sub(r"^\d{2}_", "", filename)
+            images.append(self.images.ingest(
+                os.path.join(folder, filename), original,
+                optimized=optimized, keep_original=self.optimizer.keep_original
+            ))
+        shutil.rmtree(folder, ignore_errors=True)
+        return images
+
+    def ingest_folder(self, folder):
+        # 起動時の移行用 (最適化はしない)
+        if not os.path.isdir(folder): return []
+        filenames = sorted(os.listdir(folder))
+        return self.ingest_files(folder, filenames, [None] * len(filenames))
+
+    async def ingest_uploads(self, folder, filenames=None):
+        """一時フォルダの画像を (最適化してから) 取り込む。filenames を省略するとフォルダ内すべて。"""
+        if filenames is None:
+            filenames = await asyncio.to_thread(lambda: sorted(os.listdir(folder)) if os.path.isdir(folder) else [])
+        # 縮小・再圧縮は別プロセスで並列に行う
+        variants = await asyncio.gather(*(self.optimizer.optimize(os.path.join(folder, f)) for f in filenames))
+        return await asyncio.to_thread(self.ingest_files, folder, filenames, variants)
+
+    async def apply_image_plan(self, plan, folder):
+        # ChangeContentConfirmView の plan から、更新後のマニフェストと新しく取り込んだ画像を返す
+        new_files = [item for action, item in plan if action == "new"]
+        ingested = await self.ingest_uploads(folder, new_files) if folder else []
+        it = iter(ingested)
+        return [item if action == "keep" else next(it) for action, item in plan], ingested
+
+    def migrate_image_folders(self, data):
+        # コンテンツ名ごとのフォルダに置いていた画像を、ハッシュ単位の置き場に移す (起動時に1回だけ)
+        for name, content_data in list(data["contents"].items()):
+            if not isinstance(content_data, dict) or "images" in content_data: continue
+            folder = content_data.get("path") or os.path.join(IMAGES_DIR, name)
+            images = self.ingest_folder(folder) if os.path.isdir(folder) else []
+            value = {
+                "text": content_data.get("text", ""),
+                "has_images": bool(images),
+                "images": images,
+            }
+            # 送信済みのURLは中身が同じなのでそのまま使える
+            if images and content_data.get("image_urls"): value["image_urls"] = content_data["image_urls"]
+            self.store.put(LEGACY_GUILD, "contents", name, value)
+            self.images.release(images)
+
+    async def cog_load(self):
+        # 再起動前の一時フォルダは確認ボタンがもう存在しないので、年齢に関係なく片付ける
+        removed, reclaimed = await asyncio.to_thread(self.janitor.sweep, (), 0)
+        if removed: print(f"🧹 起動時に一時フォルダを {removed} 件削除しました ({mb(reclaimed)})")
+        self.sweep_temp.start()
+        self.evict_shards.start()
+
+    async def cog_unload(self):
+        self.sweep_temp.cancel()
+        self.evict_shards.cancel()
+        self.store.close()
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        # データはサーバーごとなので、DMでは使えない
+        if interaction.guild_id is None:
+            await interaction.response.send_message("❌ このコマンドはサーバー内で使ってください。", ephemeral=True)
+            return False
+        return True
+
+    @tasks.loop(minutes=5)
+    async def evict_shards(self):
+        # しばらく使われていないサーバーのデータをメモリから降ろす
+        self.shards.sweep()
+
+    @tasks.loop(minutes=TEMP_SWEEP_MINUTES)
+    async def sweep_temp(self):
+        removed, reclaimed = await asyncio.to_thread(self.janitor.sweep, set(self.pending_uploads))
+        if removed: print(f"🧹 一時フォルダを {removed} 件削除しました ({mb(reclaimed)})")
+
+    @sweep_temp.before_loop
+    async def before_sweep_temp(self):
+        # 起動直後は cog_load で片付けたばかりなので、1周分待ってから始める
+        await asyncio.sleep(TEMP_SWEEP_MINUTES * 60)
+
+    async def release_temp(self, folder):
+        # 確認ビューが終わった (キャンセル・時間切れ) 一時フォルダを消して、空いたバイト数を返す
+        if not folder: return 0
+        self.pending_uploads.discard(folder)
+        return await asyncio.to_thread(self.janitor.remove, folder)
+
+    # 1件ずつ保存する (ファイル全体を書き直さない)
+    async def put_entry(self, guild_id, kind, name, value, ingested=()):
+        # ingested: このエントリのために取り込んだ画像。保存し終えたら消されないための押さえを外す
+        shard = await self.shard(guild_id)
+        orphans = []
+        try:
+            orphans = await asyncio.to_thread(self.store.put, guild_id, kind, name, value)
+        finally:
+            if ingested:
+                await asyncio.to_thread(self.images.release, ingested)
+                # 保存に失敗したときは、取り込んだだけの画像も消す (参照されているものは remove が残す)
+                orphans = orphans + [(img["hash"], img.get("ext", "")) for img in image_refs({"images": ingested})]
+            if orphans: await asyncio.to_thread(self.images.remove, orphans)
+        shard.put(kind, name, value)
+
+    async def delete_entry(self, guild_id, kind, name):
+        shard = await self.shard(guild_id)
+        orphans = await asyncio.to_thread(self.store.delete, guild_id, kind, name)
+        if orphans: await asyncio.to_thread(self.images.remove, orphans)
+        shard.remove(kind, name)
 
     def format_macro(self, content):
         if "\n" not in content and "/p " in content:
@@ -189,10 +424,11 @@ class Knowledge(commands.Cog):
     @app_commands.command(name="deletemacro", description="登録されたマクロを削除します")
     @app_commands.rename(name="コンテンツ名")
     async def delete_macro(self, interaction: discord.Interaction, name: str):
-        if name not in self.data["macros"]:
+        shard = await self.shard(interaction.guild_id)
+        if name not in shard.data["macros"]:
             await interaction.response.send_message(f"❌ 「{name}」なし", ephemeral=True)
             return
-        content = self.format_macro(self.data["macros"][name])
+        content = self.format_macro(shard.data["macros"][name])
         msg = f"⚠️ **本当に削除しますか？**\nコンテンツ名: `{name}`\n\n中身:\n```text\n{content}\n```"
         view = ConfirmActionView(self, "del_macro", name)
         await interaction.response.send_message(msg, view=view, ephemeral=True)
@@ -200,22 +436,27 @@ class Knowledge(commands.Cog):
     @app_commands.command(name="changemacro", description="登録されたマクロを編集します")
     @app_commands.rename(name="コンテンツ名")
     async def change_macro(self, interaction: discord.Interaction, name: str):
-        if name not in self.data["macros"]:
+        shard = await self.shard(interaction.guild_id)
+        if name not in shard.data["macros"]:
             await interaction.response.send_message(f"❌ 「{name}」なし", ephemeral=True)
             return
-        await interaction.response.send_modal(UpdateModal(self, name, self.data["macros"][name], "macro"))
+        await interaction.response.send_modal(UpdateModal(self, name, shard.data["macros"][name], "macro"))
 
     @app_commands.command(name="viewmacro", description="登録されたマクロを表示します")
     @app_commands.rename(name="コンテンツ名")
     async def view_macro(self, interaction: discord.Interaction, name: str):
-        content = self.data["macros"].get(name, "❌ なし")
+        shard = await self.shard(interaction.guild_id)
+        content = shard.data["macros"].get(name, "❌ なし")
+        shard.autocomplete["macros"].touch(name)
         await interaction.response.send_message(f"**{name}**:\n```text\n{self.format_macro(content)}\n```", ephemeral=True)
 
     @delete_macro.autocomplete("name")
     @view_macro.autocomplete("name")
     @change_macro.autocomplete("name")
     async def macro_autocomplete(self, interaction: discord.Interaction, current: str):
-        return [app_commands.Choice(name=k, value=k) for k in self.data["macros"].keys() if current.lower() in k.lower()][:25]
+        if interaction.guild_id is None: return []
+        shard = await self.shard(interaction.guild_id)
+        return [app_commands.Choice(name=k, value=k) for k in shard.autocomplete["macros"].suggest(current)]
 
     # ===============================================================
     # 攻略ボード機能
@@ -230,10 +471,11 @@ class Knowledge(commands.Cog):
     @app_commands.command(name="deletestrategyboard", description="登録されたストラテジーボードのコードを削除します")
     @app_commands.rename(name="コンテンツ名")
     async def delete_strat(self, interaction: discord.Interaction, name: str):
-        if name not in self.data["strategies"]:
+        shard = await self.shard(interaction.guild_id)
+        if name not in shard.data["strategies"]:
             await interaction.response.send_message(f"❌ 「{name}」なし", ephemeral=True)
             return
-        code = self.data["strategies"][name]
+        code = shard.data["strategies"][name]
         msg = f"⚠️ **本当に削除しますか？**\nコンテンツ名: `{name}`\n\n中身:\n```{code}```"
         view = ConfirmActionView(self, "del_strat", name)
         await interaction.response.send_message(msg, view=view, ephemeral=True)
@@ -241,22 +483,27 @@ class Knowledge(commands.Cog):
     @app_commands.command(name="changestrategyboard", description="登録されたストラテジーボードのコードを編集します")
     @app_commands.rename(name="コンテンツ名")
     async def change_strat(self, interaction: discord.Interaction, name: str):
-        if name not in self.data["strategies"]:
+        shard = await self.shard(interaction.guild_id)
+        if name not in shard.data["strategies"]:
             await interaction.response.send_message(f"❌ 「{name}」なし", ephemeral=True)
             return
-        await interaction.response.send_modal(UpdateModal(self, name, self.data["strategies"][name], "strat"))
+        await interaction.response.send_modal(UpdateModal(self, name, shard.data["strategies"][name], "strat"))
 
     @app_commands.command(name="viewstrategyboard", description="登録されたストラテジーボードのコードを表示します")
     @app_commands.rename(name="コンテンツ名")
     async def view_strat(self, interaction: discord.Interaction, name: str):
-        code = self.data["strategies"].get(name, "❌ なし")
+        shard = await self.shard(interaction.guild_id)
+        code = shard.data["strategies"].get(name, "❌ なし")
+        shard.autocomplete["strategies"].touch(name)
         await interaction.response.send_message(f"**{name}**:\n```{code}```", ephemeral=True)
 
     @delete_strat.autocomplete("name")
     @view_strat.autocomplete("name")
     @change_strat.autocomplete("name")
     async def strat_autocomplete(self, interaction: discord.Interaction, current: str):
-        return [app_commands.Choice(name=k, value=k) for k in self.data["strategies"].keys() if current.lower() in k.lower()][:25]
+        if interaction.guild_id is None: return []
+        shard = await self.shard(interaction.guild_id)
+        return [app_commands.Choice(name=k, value=k) for k in shard.autocomplete["strategies"].suggest(current)]
 
     # ===============================================================
     # コンテンツ機能 (画像・メモ)
@@ -277,8 +524,9 @@ class Knowledge(commands.Cog):
         image4: discord.Attachment = None, image5: discord.Attachment = None, image6: discord.Attachment = None,
         image7: discord.Attachment = None, image8: discord.Attachment = None, image9: discord.Attachment = None, image10: discord.Attachment = None
     ):
-        if name in self.data["contents"]:
-            await interaction.response.send_message(f"⚠️ **「{name}」** は既に存在します。\n`/deletecontent` で削除してからやり直してください。", ephemeral=True)
+        shard = await self.shard(interaction.guild_id)
+        if name in shard.data["contents"]:
+            await interaction.response.send_message(f"⚠️ **「{name}」** は既に存在します。\n`/changecontent` で更新してください。", ephemeral=True)
             return
 
         # リスト化
@@ -291,22 +539,31 @@ class Knowledge(commands.Cog):
         
         await interaction.response.defer(ephemeral=True)
 
-        combined_text = ""
-        for i, m in enumerate(memos, 1):
-            combined_text += f"📝 **メモ{i}**:\n{m}\n\n"
-        combined_text = combined_text.strip()
+        combined_text = combine_memos(memos)
+
+        error = self.check_attachment_sizes(images)
+        if error:
+            await interaction.followup.send(error, ephemeral=True)
+            return
 
-        # 一時保存
+        # 一時保存 (ダウンロードは並列、書き込みはスレッドで)
         temp_save_dir = os.path.join(TEMP_DIR, f"{name}_{interaction.id}")
         saved_files = []
         if images:
-            if not os.path.exists(temp_save_dir): os.makedirs(temp_save_dir)
-            for i, attachment in enumerate(images, 1):
-                ext = os.path.splitext(attachment.filename)[1]
-                new_filename = f"{i:02d}_{attachment.filename}"
-                file_path = os.path.join(temp_save_dir, new_filename)
-                await attachment.save(file_path)
-                saved_files.append(discord.File(file_path))
+            try:
+                downloaded = await self.download_attachments(images)
+            except ValueError as e:
+                await interaction.followup.send(f"❌ {e}", ephemeral=True)
+                return
+            except discord.HTTPException:
+                await interaction.followup.send("❌ 画像のダウンロードに失敗しました。もう一度試してください。", ephemeral=True)
+                return
+            self.pending_uploads.add(temp_save_dir)
+            await asyncio.to_thread(write_temp_files, temp_save_dir, [
+                (f"{i:02d}_{attachment.filename}", data) for i, (attachment, data) in enumerate(downloaded, 1)
+            ])
+            # プレビューはダウンロードしたデータからそのまま作る (ディスクから読み直さない)
+            saved_files = [discord.File(io.BytesIO(data), filename=attachment.filename) for attachment, data in downloaded]
 
         preview_text = f"⚠️ **以下の内容で登録しますか？**\n\n📂 **{name}**\n{combined_text}"
         view = AddContentConfirmView(self, name, combined_text, temp_save_dir if images else None)
@@ -316,14 +573,79 @@ class Knowledge(commands.Cog):
         else:
             await interaction.followup.send(preview_text, files=saved_files, view=view, ephemeral=True)
 
+    def check_attachment_sizes(self, attachments):
+        # ダウンロードする前に、Discordが教えてくれるサイズで弾く
+        for attachment in attachments:
+            if attachment.size > ATTACHMENT_MAX_BYTES:
+                return f"❌ `{attachment.filename}` が大きすぎます (1枚 {ATTACHMENT_MAX_BYTES // (1024 * 1024)}MB まで)"
+        if sum(a.size for a in attachments) > ATTACHMENT_TOTAL_BYTES:
+            return f"❌ 画像の合計が大きすぎます (合計 {ATTACHMENT_TOTAL_BYTES // (1024 * 1024)}MB まで)"
+        return None
+
+    async def download_attachments(self, attachments):
+        """添付ファイルを同時に ATTACHMENT_CONCURRENCY 件ずつ読み込み、(添付, データ) を元の順で返す。"""
+        semaphore = asyncio.Semaphore(ATTACHMENT_CONCURRENCY)
+
+        async def fetch(attachment):
+            async with semaphore:
+                data = await attachment.read()
+            # 申告されたサイズと違っていても上限は守る
+            if len(data) > ATTACHMENT_MAX_BYTES:
+                raise ValueError(f"`{attachment.filename}` が大きすぎます")
+            return attachment, data
+
+        downloaded = await asyncio.gather(*(fetch(a) for a in attachments))
+        if sum(len(data) for _, data in downloaded) > ATTACHMENT_TOTAL_BYTES:
+            raise ValueError("画像の合計が大きすぎます")
+        return downloaded
+
+    # 画像つきで送る (前に送った画像のURLがまだ使えるなら、アップロードし直さずに埋め込みで表示する)
+    def content_images(self, content_data):
+        # (ファイルのパス, 表示用のファイル名) のリスト。最適化した画像があればそちらを送る
+        return [self.images.serve(img) for img in content_data.get("images", [])]
+
+    async def send_content(self, interaction, name, content_data, text, has_images, view=None):
+        shard = await self.shard(interaction.guild_id)
+        extra = {"view": view} if view else {}
+        if not has_images:
+            await interaction.response.send_message(text, ephemeral=True, **extra)
+            return
+
+        urls = content_data.get("image_urls") or []
+        if urls and all(cdn_url_alive(u) for u in urls):
+            embeds = [discord.Embed(color=discord.Color.dark_teal()).set_image(url=u) for u in urls]
+            await interaction.response.send_message(text, embeds=embeds[:10], ephemeral=True, **extra)
+            if len(embeds) > 10:
+                await interaction.followup.send(embeds=embeds[10:], ephemeral=True)
+            return
+
+        files = [discord.File(path, filename=filename) for path, filename in self.content_images(content_data) if os.path.exists(path)]
+        if not files:
+            await interaction.response.send_message(text, ephemeral=True, **extra)
+            return
+        await interaction.response.send_message(text, files=files[:10], ephemeral=True, **extra)
+        sent = [await interaction.original_response()]
+        if len(files) > 10:
+            sent.append(await interaction.followup.send(files=files[10:], ephemeral=True, wait=True))
+
+        # 送れた画像のURLを覚えておき、次からはそれを使う
+        # (送っている間に更新・削除されていたら、古い内容で書き戻さないよう何もしない)
+        new_urls = [a.url for m in sent for a in m.attachments]
+        if len(new_urls) != len(files): return
+        value = await asyncio.to_thread(self.store.set_image_urls, interaction.guild_id, name, content_data, new_urls)
+        if value is not None and shard.data["contents"].get(name) is content_data:
+            shard.put("contents", name, value)
+
     # 2. 閲覧
     @app_commands.command(name="viewcontent", description="登録したコンテンツを表示します")
     @app_commands.rename(name="コンテンツ名")
     async def view_content(self, interaction: discord.Interaction, name: str):
-        content_data = self.data["contents"].get(name)
+        shard = await self.shard(interaction.guild_id)
+        content_data = shard.data["contents"].get(name)
         if not content_data:
             await interaction.response.send_message(f"❌ 「{name}」は見つかりません。", ephemeral=True)
             return
+        shard.autocomplete["contents"].touch(name)
         
         if isinstance(content_data, dict) and "path" in content_data: 
              text_content = ""
@@ -333,32 +655,18 @@ class Knowledge(commands.Cog):
             has_images = content_data.get("has_images", False)
 
         response_text = f"📂 **{name}**\n\n{text_content}"
-        
-        files = []
-        if has_images:
-            target_dir = os.path.join(IMAGES_DIR, name)
-            if os.path.exists(target_dir):
-                sorted_files = sorted(os.listdir(target_dir))
-                for filename in sorted_files:
-                    file_path = os.path.join(target_dir, filename)
-                    files.append(discord.File(file_path))
-
-        if not files:
-            await interaction.response.send_message(response_text, ephemeral=True)
-        else:
-            await interaction.response.send_message(response_text, files=files[:10], ephemeral=True)
-            if len(files) > 10:
-                await interaction.followup.send(files=files[10:], ephemeral=True)
+        await self.send_content(interaction, name, content_data, response_text, has_images)
 
     # 3. 削除
     @app_commands.command(name="deletecontent", description="登録されたコンテンツを削除します")
     @app_commands.rename(name="コンテンツ名")
     async def delete_content(self, interaction: discord.Interaction, name: str):
-        if name not in self.data["contents"]:
+        shard = await self.shard(interaction.guild_id)
+        if name not in shard.data["contents"]:
             await interaction.response.send_message(f"❌ 「{name}」なし", ephemeral=True)
             return
 
-        content_data = self.data["contents"][name]
+        content_data = shard.data["contents"][name]
         
         if isinstance(content_data, dict) and "path" in content_data: 
              text_content = ""
@@ -368,38 +676,326 @@ class Knowledge(commands.Cog):
             has_images = content_data.get("has_images", False)
 
         msg_text = f"⚠️ **本当に削除しますか？**\n\n📂 **{name}**\n{text_content}"
-        
-        files = []
-        if has_images:
-            target_dir = os.path.join(IMAGES_DIR, name)
-            if os.path.exists(target_dir):
-                sorted_files = sorted(os.listdir(target_dir))
-                for filename in sorted_files:
-                    file_path = os.path.join(target_dir, filename)
-                    files.append(discord.File(file_path))
-
         view = ConfirmActionView(self, "del_content", name)
+        await self.send_content(interaction, name, content_data, msg_text, has_images, view=view)
 
-        if not files:
-            await interaction.response.send_message(msg_text, view=view, ephemeral=True)
-        else:
-            await interaction.response.send_message(msg_text, files=files[:10], view=view, ephemeral=True)
+    # 4. 更新 (変わった部分だけを取り込む)
+    @app_commands.command(name="changecontent", description="コンテンツのメモや画像を更新します (指定したものだけ変わります)")
+    @app_commands.rename(
+        name="コンテンツ名",
+        memo1="メモ1", memo2="メモ2", memo3="メモ3",
+        image1="画像1", image2="画像2", image3="画像3", image4="画像4", image5="画像5",
+        image6="画像6", image7="画像7", image8="画像8", image9="画像9", image10="画像10",
+        remove="削除する画像番号"
+    )
+    @app_commands.describe(
+        memo1="指定するとメモをまるごと置き換えます (省略時は今のメモのまま)",
+        image1="画像N を指定すると N 枚目を差し替えます (今の枚数より後ろなら追加)",
+        remove="削除したい画像の番号 (例: 2,3)"
+    )
+    async def change_content(
+        self, interaction: discord.Interaction, name: str,
+        memo1: str = None, memo2: str = None, memo3: str = None,
+        image1: discord.Attachment = None, image2: discord.Attachment = None, image3: discord.Attachment = None,
+        image4: discord.Attachment = None, image5: discord.Attachment = None, image6: discord.Attachment = None,
+        image7: discord.Attachment = None, image8: discord.Attachment = None, image9: discord.Attachment = None, image10: discord.Attachment = None,
+        remove: str = None
+    ):
+        shard = await self.shard(interaction.guild_id)
+        content_data = shard.data["contents"].get(name)
+        if content_data is None:
+            await interaction.response.send_message(f"❌ 「{name}」は見つかりません。", ephemeral=True)
+            return
 
-    # 4. 更新案内
-    @app_commands.command(name="changecontent", description="コンテンツを更新します")
-    @app_commands.rename(name="コンテンツ名")
-    async def change_content(self, interaction: discord.Interaction, name: str):
-        await interaction.response.send_message(
-            f"🔄 コンテンツの更新は、一度 `/deletecontent` してから `/addcontent` し直してください！",
-            ephemeral=True
-        )
+        current = list(content_data.get("images", []))
+        slots = [image1, image2, image3, image4, image5, image6, image7, image8, image9, image10]
+        uploads = {i: a for i, a in enumerate(slots, 1) if a is not None}
+        memos = [m for m in [memo1, memo2, memo3] if m is not None]
+        removed = parse_image_numbers(remove)
+
+        if removed is None or any(n < 1 or n > len(current) for n in removed):
+            await interaction.response.send_message(f"❌ 削除する画像番号は 1〜{len(current)} の数字で指定してください。", ephemeral=True)
+            return
+        if removed & set(uploads):
+            await interaction.response.send_message("❌ 同じ番号の画像を、差し替えと削除の両方に指定しています。", ephemeral=True)
+            return
+        if not memos and not uploads and not removed:
+            await interaction.response.send_message("❌ 変更するメモ・画像・削除する画像番号のどれかを指定してください！", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True)
+
+        error = self.check_attachment_sizes(list(uploads.values()))
+        if error:
+            await interaction.followup.send(error, ephemeral=True)
+            return
+
+        old_text = content_data.get("text", "")
+        new_text = combine_memos(memos) if memos else old_text
+
+        # 送られた画像だけを読み込んで、今の画像とハッシュで比べる
+        try:
+            downloaded = await self.download_attachments(list(uploads.values()))
+        except ValueError as e:
+            await interaction.followup.send(f"❌ {e}", ephemeral=True)
+            return
+        except discord.HTTPException:
+            await interaction.followup.send("❌ 画像のダウンロードに失敗しました。もう一度試してください。", ephemeral=True)
+            return
+        hashes = await asyncio.to_thread(sha256_all, [data for _, data in downloaded])
+        new_images = {}
+        for slot, (attachment, data), hash_ in zip(uploads, downloaded, hashes):
+            if slot <= len(current) and current[slot - 1].get("source_hash", current[slot - 1]["hash"]) == hash_: continue  # 同じ画像
+            new_images[slot] = (attachment, data)
+
+        # 更新後の並びを作る
+        plan = []
+        changes = []
+        for slot in range(1, max([len(current), *uploads]) + 1):
+            if slot in removed:
+                changes.append(f"{slot}枚目を削除")
+            elif slot in new_images:
+                attachment, _ = new_images[slot]
+                plan.append(("new", f"{slot:02d}_{attachment.filename}"))
+                changes.append(f"{slot}枚目を差し替え" if slot <= len(current) else f"{len(plan)}枚目に追加")
+            elif slot <= len(current):
+                plan.append(("keep", current[slot - 1]))
+
+        if new_text == old_text and not changes:
+            await interaction.followup.send("ℹ️ 今の内容と同じなので、変更はありません。", ephemeral=True)
+            return
+
+        temp_save_dir = None
+        files = []
+        if new_images:
+            temp_save_dir = os.path.join(TEMP_DIR, f"{name}_{interaction.id}")
+            self.pending_uploads.add(temp_save_dir)
+            await asyncio.to_thread(write_temp_files, temp_save_dir, [
+                (f"{slot:02d}_{attachment.filename}", data) for slot, (attachment, data) in new_images.items()
+            ])
+            # プレビューには変わった画像だけを付ける
+            files = [discord.File(io.BytesIO(data), filename=attachment.filename) for attachment, data in new_images.values()]
+
+        lines = [f"⚠️ **以下の内容で更新しますか？**\n\n📂 **{name}**"]
+        if new_text != old_text:
+            lines.append(f"📝 メモを置き換えます:\n{new_text}")
+        if changes:
+            kept = sum(1 for action, _ in plan if action == "keep")
+            lines.append(f"🖼️ 画像: {'、'.join(changes)} (そのままの画像 {kept}枚 / 更新後 {len(plan)}枚)")
+        view = ChangeContentConfirmView(self, name, new_text, plan, temp_save_dir)
+        extra = {"files": files} if files else {}
+        await interaction.followup.send("\n\n".join(lines), view=view, ephemeral=True, **extra)
 
     # オートコンプリート
     @view_content.autocomplete("name")
     @delete_content.autocomplete("name")
     @change_content.autocomplete("name")
     async def content_autocomplete(self, interaction: discord.Interaction, current: str):
-        return [app_commands.Choice(name=k, value=k) for k in self.data["contents"].keys() if current.lower() in k.lower()][:25]
+        if interaction.guild_id is None: return []
+        shard = await self.shard(interaction.guild_id)
+        return [app_commands.Choice(name=k, value=k) for k in shard.autocomplete["contents"].suggest(current)]
+
+    # ===============================================================
+    # 全文検索
+    # ===============================================================
+    @app_commands.command(name="searchknowledge", description="登録されたマクロ・攻略ボード・コンテンツを中身から検索します")
+    @app_commands.rename(query="キーワード", kind="種類")
+    @app_commands.choices(kind=[
+        app_commands.Choice(name="すべて", value="all"),
+        app_commands.Choice(name="マクロ", value="macros"),
+        app_commands.Choice(name="攻略ボード", value="strategies"),
+        app_commands.Choice(name="コンテンツ", value="contents"),
+    ])
+    async def search_knowledge(self, interaction: discord.Interaction, query: str, kind: str = "all"):
+        shard = await self.shard(interaction.guild_id)
+        started = time.perf_counter()
+        hits = shard.index.search(query, limit=10, kinds=None if kind == "all" else {kind})
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        if not hits:
+            await interaction.response.send_message(f"🔎 「{query}」に一致するものは見つかりませんでした。", ephemeral=True)
+            return
+
+        view_commands = {"macros": "/viewmacro", "strategies": "/viewstrategyboard", "contents": "/viewcontent"}
+        embed = discord.Embed(title=f"🔎 「{query}」の検索結果", color=discord.Color.green())
+        for i, hit in enumerate(hits, 1):
+            snippet = make_snippet(hit["text"], query) or "(本文なし)"
+            embed.add_field(
+                name=f"{i}. [{KIND_LABELS[hit['kind']]}] {hit['name']}"[:256],
+                value=f"{snippet}\n`{view_commands[hit['kind']]}` で表示"[:1024],
+                inline=False
+            )
+        embed.set_footer(text=f"{len(hits)} 件 / {elapsed_ms:.1f} ms")
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="tempstats", description="画像の一時フォルダの掃除状況を表示します (管理者用)")
+    @app_commands.default_permissions(administrator=True)
+    async def temp_stats(self, interaction: discord.Interaction):
+        st = await asyncio.to_thread(self.janitor.stats)
+        lines = [
+            "🧹 **一時フォルダ**",
+            f"いま: {st['folders']} 件 / {mb(st['bytes'])} (上限 {mb(self.janitor.max_bytes)}) | 確認待ち {len(self.pending_uploads)} 件",
+            f"これまでに削除: {st['removed']} 件 / {mb(st['reclaimed'])} (見回り {st['sweeps']} 回)",
+        ]
+        opt = self.optimizer.stats()
+        if opt["available"]:
+            lines.append(f"🖼️ 画像の最適化: {opt['optimized']} 件 (そのまま {opt['skipped']} 件) / {mb(opt['saved_bytes'])} 削減")
+        else:
+            lines.append("🖼️ 画像の最適化: 無効 (Pillow 未導入か IMAGE_OPTIMIZE=0)")
+        await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+    # ===============================================================
+    # まとめて書き出し・取り込み (別のBotへの引っ越し用)
+    # ===============================================================
+    async def run_with_progress(self, interaction, title, progress, func, *args):
+        # func はスレッドで実行し、その間ときどき進み具合を表示する
+        task = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=PROGRESS_INTERVAL)
+            if done: return task.result()
+            stage, n, total, nbytes = progress.snapshot()
+            try:
+                await interaction.edit_original_response(content=f"⏳ {title}: {stage}… {n} / {total} ({mb(nbytes)})")
+            except discord.HTTPException:
+                pass
+
+    async def download_to_file(self, url, path):
+        # 添付ファイルを少しずつファイルに書き出す (全体をメモリに載せない)
+        f = await asyncio.to_thread(open, path, "wb")
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url) as resp:
+                    resp.raise_for_status()
+                    buffer = bytearray()
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        buffer += chunk
+                        if len(buffer) >= 1024 * 1024:
+                            await asyncio.to_thread(f.write, bytes(buffer))
+                            buffer.clear()
+                    if buffer: await asyncio.to_thread(f.write, bytes(buffer))
+        finally:
+            await asyncio.to_thread(f.close)
+
+    @app_commands.command(name="exportknowledge", description="このサーバーのマクロ・攻略ボード・コンテンツを画像ごと1つのファイルに書き出します (管理者用)")
+    @app_commands.default_permissions(administrator=True)
+    @app_commands.rename(destination="保存先")
+    @app_commands.choices(destination=[
+        app_commands.Choice(name="Discordに添付する", value="discord"),
+        app_commands.Choice(name="Botのサーバーに保存する", value="file"),
+    ])
+    async def export_knowledge(self, interaction: discord.Interaction, destination: str = "discord"):
+        await interaction.response.defer(ephemeral=True)
+        guild_id = interaction.guild_id
+        filename = f"knowledge_{guild_id}_{time.strftime('%Y%m%d_%H%M%S')}.tar.gz"
+        path = os.path.join(EXPORT_DIR, filename)
+
+        progress = Progress()
+        try:
+            result = await self.run_with_progress(
+                interaction, "書き出し", progress, export_archive, self.store, self.images, guild_id, path, progress
+            )
+        except Exception as e:
+            print(f"❌ Export Error (Guild: {guild_id}): {e}")
+            await interaction.edit_original_response(content="❌ 書き出しに失敗しました。")
+            return
+
+        summary = f"📦 エントリ {result['entries']} 件・画像 {result['blobs']} 枚を書き出しました ({mb(result['bytes'])})"
+        if result["missing"]:
+            summary += f"\n⚠️ 見つからなかった画像が {result['missing']} 枚ありました。"
+        if destination == "discord":
+            if result["bytes"] <= interaction.guild.filesize_limit:
+                await interaction.edit_original_response(content=summary, attachments=[discord.File(path, filename=filename)])
+                await asyncio.to_thread(os.remove, path)
+                return
+            summary += f"\n⚠️ Discordに添付できる大きさ ({mb(interaction.guild.filesize_limit)}) を超えたので、Botのサーバーに保存しました。"
+        summary += f"\n保存先: `{path}` (`/importknowledge` の保存済みファイル名で指定できます)"
+        await interaction.edit_original_response(content=summary)
+
+    @app_commands.command(name="importknowledge", description="書き出したファイルからマクロ・攻略ボード・コンテンツを取り込みます (管理者用)")
+    @app_commands.default_permissions(administrator=True)
+    @app_commands.rename(file="ファイル", filename="保存済みファイル名", mode="同じ名前があるとき")
+    @app_commands.choices(mode=[
+        app_commands.Choice(name="今のものを残す", value="merge"),
+        app_commands.Choice(name="ファイルの内容で上書きする", value="overwrite"),
+    ])
+    async def import_knowledge(
+        self, interaction: discord.Interaction,
+        file: discord.Attachment = None, filename: str = None, mode: str = "merge"
+    ):
+        if (file is None) == (filename is None):
+            await interaction.response.send_message("❌ ファイルを添付するか、保存済みファイル名を指定してください (どちらか一方)。", ephemeral=True)
+            return
+        if file is not None and file.size > IMPORT_MAX_BYTES:
+            await interaction.response.send_message(f"❌ ファイルが大きすぎます ({mb(IMPORT_MAX_BYTES)} まで)", ephemeral=True)
+            return
+        await interaction.response.defer(ephemeral=True)
+        guild_id = interaction.guild_id
+
+        temp_folder = None
+        if file is not None:
+            temp_folder = os.path.join(TEMP_DIR, f"import_{interaction.id}")
+            self.pending_uploads.add(temp_folder)
+            await asyncio.to_thread(os.makedirs, temp_folder, exist_ok=True)
+            path = os.path.join(temp_folder, "archive.tar.gz")
+        else:
+            # Botのサーバー上のファイルは exports の中のものだけ
+            path = os.path.join(EXPORT_DIR, os.path.basename(filename))
+
+        progress = Progress()
+        try:
+            if file is not None:
+                await interaction.edit_original_response(content=f"⏳ ファイルを受け取り中… ({mb(file.size)})")
+                await self.download_to_file(file.url, path)
+            elif not await asyncio.to_thread(os.path.isfile, path):
+                await interaction.edit_original_response(content=f"❌ `{os.path.basename(filename)}` が見つかりません。")
+                return
+            result = await self.run_with_progress(
+                interaction, "取り込み", progress, import_archive, self.store, self.images, guild_id, path, mode, progress
+            )
+        except (ValueError, tarfile.TarError) as e:
+            await interaction.edit_original_response(content=f"❌ 取り込めませんでした: {e}")
+            return
+        except Exception as e:
+            print(f"❌ Import Error (Guild: {guild_id}): {e}")
+            await interaction.edit_original_response(content="❌ 取り込みに失敗しました。")
+            return
+        finally:
+            await self.release_temp(temp_folder)
+            # 一部だけ取り込めた場合もあるので、メモリ上のデータは読み込み直させる
+            self.shards.invalidate(guild_id)
+
+        lines = [
+            f"📥 取り込みました: 追加 {result['added']} 件 / 上書き {result['updated']} 件 / そのまま {result['skipped']} 件",
+            f"画像: 新しく保存 {result['blobs']} 枚 / すでにあったもの {result['reused']} 枚",
+        ]
+        if result["bad"]:
+            lines.append(f"⚠️ 画像が壊れている・足りないため取り込まなかったエントリ: {result['bad']} 件")
+        await interaction.edit_original_response(content="\n".join(lines))
+
+    @import_knowledge.autocomplete("filename")
+    async def export_file_autocomplete(self, interaction: discord.Interaction, current: str):
+        names = await asyncio.to_thread(lambda: sorted((f for f in os.listdir(EXPORT_DIR) if f.endswith(".tar.gz")), reverse=True))
+        return [app_commands.Choice(name=f, value=f) for f in names if current.lower() in f.lower()][:25]
+
+    @app_commands.command(name="claimlegacyknowledge", description="サーバーごとに分ける前のマクロ・攻略ボード・コンテンツを、このサーバーのものにします (管理者用)")
+    @app_commands.default_permissions(administrator=True)
+    async def claim_legacy_knowledge(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True)
+        guild_id = interaction.guild_id
+        legacy = await asyncio.to_thread(self.store.count, LEGACY_GUILD)
+        if not legacy:
+            await interaction.edit_original_response(content="ℹ️ 引き取れるデータはありません (すでにどこかのサーバーが引き取り済みです)。")
+            return
+        claimed = await asyncio.to_thread(self.store.claim_legacy, guild_id)
+        if not claimed:
+            await interaction.edit_original_response(
+                content=f"❌ このサーバーにはすでにデータがあるので引き取れません (分ける前のデータ {legacy} 件)。"
+            )
+            return
+        print(f"📦 サーバーごとに分ける前のデータ {claimed} 件を、サーバー {guild_id} のものにしました")
+        # メモリ上のデータは読み込み直させる
+        self.shards.invalidate(guild_id)
+        await interaction.edit_original_response(content=f"📦 分ける前のデータ {claimed} 件を、このサーバーのものにしました。")
 
 async def setup(bot):
     await bot.add_cog(Knowledge(bot))
\ No newline at end of file
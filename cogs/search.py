@@ -1,45 +1,149 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-from duckduckgo_search import DDGS
-import google.generativeai as genai
 import os
+from utils.cache import TTLCache
+from utils.knowledge_index import KIND_LABELS, format_snippet
+from utils.llm import SEARCH_MODEL, error_message, get_gateway
+from utils.metrics import get_meter
+from utils.ratelimit import QueueFull, QueueNotice, get_limiter
+from utils.singleflight import SingleFlight
+from utils.text import normalize_text, split_message
+from utils.web_search import WebSearcher
+from utils.worker import ProcessSearcher, get_worker_pool
+
+# 検索結果キャッシュの設定
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))   # 保持するクエリ数
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "1800"))    # 有効期限 (秒)
+
+# 広めに候補を集めて、手元で並べ替えた上位だけをGeminiに渡す
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "10"))    # 検索で集める候補数
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", "3"))               # プロンプトに入れる件数
 
 class Search(commands.Cog):
-    def __init__(self, bot):
+    def __init__(self, bot, searcher=None, llm=None):
         self.bot = bot
-        try:
-            genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-            self.model = genai.GenerativeModel('gemini-1.5-flash')
-        except: pass
+        # Web検索はスレッド (AI_WORKER_PROCESSES を設定したらワーカープロセス) で実行する
+        # テストでは偽のバックエンドを持つ WebSearcher を渡せる
+        if searcher is None:
+            pool = get_worker_pool()
+            searcher = ProcessSearcher(pool) if pool is not None else WebSearcher()
+        self.searcher = searcher
+        self.llm = llm or get_gateway()
+        self.limiter = get_limiter()
+        self.meter = get_meter()
+        # 同じ質問が続いたときにWeb検索とGeminiを呼び直さないためのキャッシュ
+        self.result_cache = TTLCache(max_entries=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+        self.answer_cache = TTLCache(max_entries=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+        # 同じ質問が同時に来たら、最初の1件の結果をみんなで待つ
+        self.inflight = SingleFlight()
 
-    @app_commands.command(name="search", description="【現在使えないと思います】Webを検索してFF14の情報を探します")
-    async def search(self, interaction: discord.Interaction, query: str):
-        await interaction.response.defer(ephemeral=True)
-        try:
+    async def cog_unload(self):
+        self.searcher.shutdown()
+
+    async def fetch_results(self, query):
+        """(結果, cacheable) を返す。"""
+        key = normalize_text(query)
+        results = self.result_cache.get(key)
+        if results is not None: return results, True
+        # 並べ替え済みの上位だけを覚えておく (同じクエリなら並べ替えの結果も同じ)
+        results, complete = await self.searcher.search_ranked(query, SEARCH_CANDIDATES, SEARCH_TOP_K)
+        # タイムアウト・エラーで欠けた結果や0件は、たまたまの可能性があるので覚えない
+        cacheable = complete and bool(results)
+        if cacheable: self.result_cache.set(key, results)
+        return results, cacheable
+
+    def knowledge_reply(self, knowledge, hit):
+        if hit["kind"] == "macros":
+            body = f"```text\n{knowledge.format_macro(hit['text'])}\n```"
+        elif hit["kind"] == "strategies":
+            body = f"```{hit['text']}```"
+        else:
+            body = f"{hit['text']}\n\n(画像は `/viewcontent` で確認できます)"
+        return f"📚 **登録済みの{KIND_LABELS[hit['kind']]}「{hit['name']}」**\n{body}"
+
+    async def build_reply(self, query, guild_id=None, usage=None):
+        # 登録済みのナレッジ (そのサーバーのもの) でそのまま答えられるなら、Web検索もGeminiも使わない
+        knowledge = self.bot.get_cog("Knowledge")
+        index = None
+        if knowledge is not None and guild_id is not None:
+            index = (await knowledge.shard(guild_id)).index
+            hit = index.confident(query)
+            if hit is not None:
+                return self.knowledge_reply(knowledge, hit)
+
+        # 要約にはサーバーごとの登録情報が混ざるので、サーバー単位で覚えておく
+        key = (guild_id, normalize_text(query))
+        answer = self.answer_cache.get(key)
+        if answer is None:
+            results, cacheable = await self.fetch_results(query)
             results_text = ""
-            with DDGS() as ddgs:
-                results = list(ddgs.text(f"{query} FF14", region='jp-jp', max_results=3))
-                for r in results:
-                    results_text += f"Title: {r['title']}\nURL: {r['href']}\nSummary: {r['body']}\n---\n"
+            for r in results:
+                results_text += f"Title: {r['title']}\nURL: {r['href']}\nSummary: {r['body']}\n---\n"
 
-            if not results_text:
-                await interaction.followup.send("ごめん、それっぽい情報が見つからなかった…", ephemeral=True)
-                return
+            knowledge_text = ""
+            if index is not None:
+                knowledge_text = "\n---\n".join(format_snippet(h) for h in index.relevant(query))
+
+            if not results_text and not knowledge_text:
+                return "ごめん、それっぽい情報が見つからなかった…"
 
             prompt = f"""
             ユーザーの質問「{query}」に対し、以下の検索結果を元にFF14プレイヤー向けに要約してください。
+            「ギルドの登録情報」がある場合は、Webの検索結果よりも優先して使ってください。
             もし検索結果がFF14と全く無関係なら「FF14に関する情報はなさそうです」と答えてください。
+
+            ギルドの登録情報:
+            {knowledge_text or "(なし)"}
             
             検索結果:
-            {results_text}
+            {results_text or "(なし)"}
             """
-            response = self.model.generate_content(prompt)
-            await interaction.followup.send(f"🔍 **「{query}」の検索結果**\n{response.text}", ephemeral=True)
+            answer = await self.llm.generate(prompt, model=SEARCH_MODEL, usage=usage)
+            # 検索結果が欠けていたときの要約も覚えない (次はちゃんと検索し直す)
+            if cacheable: self.answer_cache.set(key, answer)
+
+        return f"🔍 **「{query}」の検索結果**\n{answer}"
+
+    @app_commands.command(name="search", description="Webを検索してFF14の情報を探します")
+    async def search(self, interaction: discord.Interaction, query: str):
+        await interaction.response.defer(ephemeral=True)
+        notice = QueueNotice(interaction)
+        try:
+            async with self.meter.track("search", interaction.user.id) as measure:
+                # /chat と共通の制限 (全体・1人あたりの回数、同じ人は1件ずつ)
+                async with self.limiter.slot(interaction.user.id, on_queued=notice):
+                    await notice.done()
+                    # トークン数は実際にGeminiを呼んだ1件にだけ記録される
+                    reply_text = await self.inflight.do(
+                        (interaction.guild_id, normalize_text(query)),
+                        lambda: self.build_reply(query, interaction.guild_id, measure.usage)
+                    )
+                # 登録済みのマクロ・メモや長い要約は2000文字を超えることがあるので分けて送る
+                for page in split_message(reply_text):
+                    await interaction.followup.send(page, ephemeral=True)
+
+        except QueueFull:
+            await interaction.followup.send("😵 いま混み合っていて受け付けられないみたい…少し待ってからもう一度試してね。", ephemeral=True)
 
         except Exception as e:
-            print(e)
-            await interaction.followup.send("検索エラーが発生しました。", ephemeral=True)
+            print(f"❌ Search Error (Query: {query}): {e}")
+            await interaction.followup.send(f"検索エラーが発生しました。\n{error_message(e)}", ephemeral=True)
+
+    @app_commands.command(name="searchstats", description="検索キャッシュの状況を表示します (管理者用)")
+    @app_commands.default_permissions(administrator=True)
+    async def search_stats(self, interaction: discord.Interaction):
+        lines = ["🔍 **検索キャッシュ**"]
+        for label, cache in [("検索結果", self.result_cache), ("要約", self.answer_cache)]:
+            st = cache.stats()
+            lines.append(
+                f"{label}: {st['size']} / {st['max_entries']} 件 | "
+                f"ヒット {st['hits']} / ミス {st['misses']} (ヒット率 {st['hit_rate']:.0%}) | "
+                f"追い出し {st['evictions']} / 期限切れ {st['expirations']}"
+            )
+        lines.append(f"Web検索のタイムアウト: {self.searcher.timeouts} 件")
+        lines.append(f"同時リクエストの相乗り: {self.inflight.shared} 件 (実行 {self.inflight.started} 件)")
+        await interaction.response.send_message("\n".join(lines), ephemeral=True)
 
 async def setup(bot):
     await bot.add_cog(Search(bot))
\ No newline at end of file
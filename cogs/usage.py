@@ -0,0 +1,78 @@
+import discord
+from discord.ext import commands
+from discord import app_commands
+from utils.metrics import WINDOWS, get_meter
+
+COMMAND_LABELS = {"chat": "/chat", "chat_summary": "/chat (要約)", "search": "/search"}
+SHORT_LABELS = {"chat": "chat", "chat_summary": "要約", "search": "search"}  # ユーザー別の内訳用
+
+FIELD_LIMIT = 1024  # Discordの埋め込みの1フィールドの上限
+
+def fmt_sec(v):
+    return "-" if v is None else f"{v:.1f}s"
+
+def fmt_count(n):
+    # 1234 -> 1.2k のように縮める
+    if n >= 1_000_000: return f"{n / 1_000_000:.1f}M"
+    if n >= 1_000: return f"{n / 1_000:.1f}k"
+    return str(n)
+
+def pack_fields(lines, limit=FIELD_LIMIT):
+    # 1フィールドに収まる分ずつ行をまとめる (1行が長すぎるときは切り詰める)
+    fields = [""]
+    for line in lines:
+        line = line[:limit]
+        if fields[-1] and len(fields[-1]) + 1 + len(line) > limit:
+            fields.append("")
+        fields[-1] += ("\n" if fields[-1] else "") + line
+    return fields
+
+class Usage(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.meter = get_meter()
+
+    async def cog_unload(self):
+        self.meter.save()
+
+    @app_commands.command(name="llmusage", description="AIコマンドの利用状況を表示します (管理者用)")
+    @app_commands.default_permissions(administrator=True)
+    @app_commands.rename(window="期間")
+    @app_commands.choices(window=[app_commands.Choice(name=label, value=sec) for label, sec in WINDOWS])
+    async def llm_usage(self, interaction: discord.Interaction, window: int = 24 * 3600):
+        label = next((l for l, sec in WINDOWS if sec == window), f"{window}秒")
+        commands_summary, users = self.meter.summary(window)
+
+        embed = discord.Embed(title=f"📊 AIコマンドの利用状況 (直近{label})", color=discord.Color.blurple())
+        if not commands_summary:
+            embed.description = "この期間の利用はありません。"
+        for name, c in sorted(commands_summary.items()):
+            embed.add_field(
+                name=COMMAND_LABELS.get(name, name),
+                value=(
+                    f"リクエスト: **{c['requests']}** (エラー {c['errors']} / {c['error_rate']:.0%})\n"
+                    f"Gemini呼び出し: {c['llm_calls']}\n"
+                    f"トークン: 入力 {c['input_tokens']:,} / 出力 {c['output_tokens']:,}\n"
+                    f"応答時間: p50 {fmt_sec(c['p50'])} / p95 {fmt_sec(c['p95'])} / p99 {fmt_sec(c['p99'])}"
+                ),
+                inline=False
+            )
+
+        if users:
+            total = lambda counts, field: sum(c[field] for c in counts.values())
+            top = sorted(users.items(), key=lambda x: -total(x[1], "requests"))[:10]
+            lines = []
+            for user_id, counts in top:
+                detail = "・".join(f"{SHORT_LABELS.get(k, k)} {c['requests']}" for k, c in sorted(counts.items()))
+                lines.append(
+                    f"<@{user_id}>: {total(counts, 'requests')}回 ({detail}) / Gemini {total(counts, 'llm_calls')} / "
+                    f"入力 {fmt_count(total(counts, 'input_tokens'))}・出力 {fmt_count(total(counts, 'output_tokens'))}"
+                )
+            # 1フィールド1024文字までなので、溢れる分は続きのフィールドに分ける
+            for i, value in enumerate(pack_fields(lines)):
+                embed.add_field(name="よく使っている人 (上位10人)" if i == 0 else "(続き)", value=value, inline=False)
+
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+async def setup(bot):
+    await bot.add_cog(Usage(bot))
\ No newline at end of file
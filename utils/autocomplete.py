@@ -0,0 +1,99 @@
+import bisect
+import time
+from collections import defaultdict
+from utils.text import normalize_text
+
+# ------------------------------------------------------------------
+# 名前の入力補完用インデックス
+# ------------------------------------------------------------------
+def grams(text):
+    # 1文字と2文字の部分文字列 (部分一致の候補を絞り込むのに使う)
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+class AutocompleteIndex:
+    """前方一致・部分一致で名前を探し、一致の良さと最近使ったかで並べる。
+
+    ひらがな/カタカナ・全角/半角・大文字/小文字の違いは normalize_text で吸収する。
+    追加・削除のたびに差分だけを更新する。
+    """
+
+    def __init__(self, names=()):
+        self.normalized = {}          # 名前 -> 正規化した名前
+        self.sorted_keys = []         # (正規化した名前, 名前) を並べたもの (前方一致を二分探索する)
+        self.grams = defaultdict(set) # 部分文字列 -> 名前の集合
+        self.last_used = {}           # 名前 -> 最後に使った時刻
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        if name in self.normalized: return
+        norm = normalize_text(name)
+        self.normalized[name] = norm
+        bisect.insort(self.sorted_keys, (norm, name))
+        for g in grams(norm):
+            self.grams[g].add(name)
+
+    def remove(self, name):
+        norm = self.normalized.pop(name, None)
+        if norm is None: return
+        i = bisect.bisect_left(self.sorted_keys, (norm, name))
+        if i < len(self.sorted_keys) and self.sorted_keys[i] == (norm, name):
+            del self.sorted_keys[i]
+        for g in grams(norm):
+            names = self.grams.get(g)
+            if names is None: continue
+            names.discard(name)
+            if not names: del self.grams[g]
+        self.last_used.pop(name, None)
+
+    def touch(self, name):
+        if name in self.normalized:
+            self.last_used[name] = time.time()
+
+    def _prefix_matches(self, query):
+        i = bisect.bisect_left(self.sorted_keys, (query, ""))
+        while i < len(self.sorted_keys) and self.sorted_keys[i][0].startswith(query):
+            yield self.sorted_keys[i][1]
+            i += 1
+
+    def _substring_candidates(self, query):
+        # クエリの2文字ずつを全部含む名前だけを候補にする
+        keys = [query[i:i + 2] for i in range(len(query) - 1)] or [query]
+        sets = sorted((self.grams.get(k, set()) for k in keys), key=len)
+        if not sets: return set()
+        result = set(sets[0])
+        for s in sets[1:]:
+            result &= s
+            if not result: break
+        return result
+
+    def suggest(self, current, limit=25):
+        query = normalize_text(current)
+        if not query:
+            # 未入力なら最近使ったもの → 名前順
+            recent = sorted(self.last_used, key=lambda n: -self.last_used[n])
+            rest = (name for _, name in self.sorted_keys if name not in self.last_used)
+            result = recent[:limit]
+            for name in rest:
+                if len(result) >= limit: break
+                result.append(name)
+            return result
+
+        ranked = []
+        seen = set()
+        for name in self._prefix_matches(query):
+            seen.add(name)
+            ranked.append((0 if self.normalized[name] == query else 1, name))
+        for name in self._substring_candidates(query) - seen:
+            norm = self.normalized[name]
+            pos = norm.find(query)
+            if pos < 0: continue
+            # 単語の頭で一致していれば、途中での一致より上にする
+            rank = 2 if norm[pos - 1] in " _-/・(（[「" else 3
+            ranked.append((rank, name))
+
+        ranked.sort(key=lambda x: (x[0], -self.last_used.get(x[1], 0), len(x[1]), x[1]))
+        return [name for _, name in ranked[:limit]]
+
+    def __len__(self):
+        return len(self.normalized)
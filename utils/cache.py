@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+
+# ------------------------------------------------------------------
+# 件数上限 (LRU) と有効期限 (TTL) つきのキャッシュ
+# ------------------------------------------------------------------
+class TTLCache:
+    """件数上限を超えたら古いものから捨て、期限切れのものは取り出し時に捨てるキャッシュ。
+
+    sliding=True の場合はアクセスのたびに期限を延長する (放置時間で期限切れ)。
+    sliding=False の場合は登録時刻から ttl 秒で期限切れになる。
+    """
+
+    def __init__(self, max_entries=256, ttl=None, sliding=False, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sliding = sliding
+        self.on_evict = on_evict  # (key, value) を受け取るコールバック
+        self._data = OrderedDict()  # key -> [value, expires_at]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expires_at(self):
+        if self.ttl is None: return None
+        return time.monotonic() + self.ttl
+
+    def _drop(self, key, expired):
+        value, _ = self._data.pop(key)
+        if expired: self.expirations += 1
+        else: self.evictions += 1
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            self._drop(key, expired=True)
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        if self.sliding:
+            entry[1] = self._expires_at()
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        if key in self._data:
+            self._data.move_to_end(key)
+        self._data[key] = [value, self._expires_at()]
+        self.sweep()
+        while len(self._data) > self.max_entries:
+            oldest = next(iter(self._data))
+            self._drop(oldest, expired=False)
+
+    def pop(self, key, default=None):
+        # 明示的な削除はevictとして数えない
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def sweep(self):
+        # 先頭 (最も長く使われていないもの) から期限切れを捨てる
+        now = time.monotonic()
+        removed = 0
+        while self._data:
+            key, (_, expires_at) = next(iter(self._data.items()))
+            if expires_at is None or expires_at > now: break
+            self._drop(key, expired=True)
+            removed += 1
+        return removed
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and (entry[1] is None or entry[1] > time.monotonic())
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
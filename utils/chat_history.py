@@ -0,0 +1,80 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DATA_DIR = "data"
+CHAT_DB_FILE = os.path.join(DATA_DIR, "chat_history.db")
+
+def new_state(summary="", history=None):
+    return {"summary": summary, "history": history if history is not None else []}
+
+# ------------------------------------------------------------------
+# /chat の会話履歴をSQLiteに保存する
+# ------------------------------------------------------------------
+class ChatHistoryDB:
+    """ユーザーごとの会話状態を1行ずつ保存する。
+
+    状態は {"summary": "古い会話の要約", "history": [{"role": "user" | "model", "text": "..."}]}
+    をJSONにして持つ。
+    sqlite3はブロッキングなので、Cog側からは asyncio.to_thread 経由で呼ぶこと。
+    """
+
+    def __init__(self, path=CHAT_DB_FILE):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # 起動を遅くしないよう、初めて使うときに開く
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_history ("
+                " user_id INTEGER PRIMARY KEY,"
+                " history TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def load(self, user_id):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT history FROM chat_history WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if not row: return new_state()
+        try:
+            state = json.loads(row[0])
+        except ValueError:
+            return new_state()
+        # 要約を持つ前の形式 (履歴のリストだけ) も読めるようにする
+        if isinstance(state, list):
+            return new_state(history=state)
+        return new_state(summary=state.get("summary", ""), history=state.get("history", []))
+
+    def save(self, user_id, state):
+        payload = json.dumps({"summary": state["summary"], "history": state["history"]}, ensure_ascii=False)
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO chat_history (user_id, history, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(user_id) DO UPDATE SET history = excluded.history, updated_at = excluded.updated_at",
+                (user_id, payload, time.time()),
+            )
+            conn.commit()
+
+    def delete(self, user_id):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+            conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
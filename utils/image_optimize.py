@@ -0,0 +1,125 @@
+import asyncio
+import atexit
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Pillow は requirements.txt に入っている。万一入っていない環境でも止まらないよう、そのときは画像をそのまま保存する
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# ------------------------------------------------------------------
+# 設定 (.env で上書きできる)
+# ------------------------------------------------------------------
+IMAGE_OPTIMIZE = os.getenv("IMAGE_OPTIMIZE", "1") == "1"                 # 0 にすると最適化しない
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "2048"))      # 長辺をこのピクセル数までに縮める
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "webp")                         # "webp" か "png"
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "85"))
+IMAGE_KEEP_ORIGINAL = os.getenv("IMAGE_KEEP_ORIGINAL", "1") == "1"       # 元の画像も残すか
+IMAGE_PROCESSES = int(os.getenv("IMAGE_PROCESSES", "1"))                 # 変換に使うプロセス数
+
+# ------------------------------------------------------------------
+# 子プロセス側
+# ------------------------------------------------------------------
+def _optimize_image(src_path, max_dimension, fmt, quality):
+    """縮小・再圧縮したファイルのパスを返す。小さくならない・画像でないときは None。"""
+    dst_base = os.path.splitext(src_path)[0] + ".opt"
+    try:
+        with Image.open(src_path) as im:
+            # アニメーションGIFなどはそのまま
+            if getattr(im, "is_animated", False): return None
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            if fmt == "webp":
+                if im.mode not in ("RGB", "RGBA"):
+                    im = im.convert("RGBA" if im.mode in ("P", "LA", "PA") or "transparency" in im.info else "RGB")
+                out = dst_base + ".webp"
+                im.save(out, "WEBP", quality=quality, method=6)
+            else:
+                out = dst_base + ".png"
+                im.save(out, "PNG", optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    if os.path.getsize(out) >= os.path.getsize(src_path):
+        os.remove(out)
+        return None
+    return out
+
+# ------------------------------------------------------------------
+# Bot側
+# ------------------------------------------------------------------
+class ImageOptimizer:
+    """登録された画像を縮小・再圧縮する。
+
+    変換はCPUを使うので、イベントループとは別のプロセス (spawn) で行う。
+    Pillow が無い・IMAGE_OPTIMIZE=0 のときは何もしない (optimize が None を返す)。
+    """
+
+    def __init__(self, processes=IMAGE_PROCESSES, max_dimension=IMAGE_MAX_DIMENSION,
+                 fmt=IMAGE_FORMAT, quality=IMAGE_WEBP_QUALITY, keep_original=IMAGE_KEEP_ORIGINAL):
+        self.processes = processes
+        self.max_dimension = max_dimension
+        self.fmt = fmt
+        self.quality = quality
+        self.keep_original = keep_original
+        self.executor = None
+
+        self.optimized = 0
+        self.skipped = 0
+        self.saved_bytes = 0
+
+    @property
+    def available(self):
+        return IMAGE_OPTIMIZE and Image is not None
+
+    def _executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=max(1, self.processes),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            atexit.register(self.shutdown)
+        return self.executor
+
+    async def optimize(self, src_path):
+        """最適化したファイルのパス (元ファイルと同じフォルダ) か None を返す。"""
+        if not self.available: return None
+        loop = asyncio.get_running_loop()
+        try:
+            out = await loop.run_in_executor(
+                self._executor(), _optimize_image, src_path, self.max_dimension, self.fmt, self.quality
+            )
+        except Exception as e:
+            print(f"⚠️ 画像の最適化に失敗しました ({os.path.basename(src_path)}): {e}")
+            out = None
+        if out is None:
+            self.skipped += 1
+        else:
+            self.optimized += 1
+            self.saved_bytes += os.path.getsize(src_path) - os.path.getsize(out)
+        return out
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "available": self.available,
+            "optimized": self.optimized,
+            "skipped": self.skipped,
+            "saved_bytes": self.saved_bytes,
+        }
+
+_optimizer = None
+
+def get_optimizer():
+    global _optimizer
+    if _optimizer is None:
+        _optimizer = ImageOptimizer()
+        if IMAGE_OPTIMIZE and Image is None:
+            print("⚠️ Pillow が見つからないので、画像は最適化せずにそのまま保存します (pip install -r requirements.txt で入ります)。")
+    return _optimizer
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import shutil
+
+from utils.knowledge_store import image_refs
+
+DATA_DIR = "data"
+IMAGES_DIR = os.path.join(DATA_DIR, "images")
+BLOBS_DIR = os.path.join(IMAGES_DIR, "blobs")
+
+def file_hash(path):
+    # (sha256, サイズ)。大きな画像でもメモリに全部は載せない
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+# ------------------------------------------------------------------
+# 画像をハッシュ値で1つだけ保存する (同じ画像は何件のコンテンツで使っても1ファイル)
+# ------------------------------------------------------------------
+class ImageStore:
+    """data/images/blobs/<ハッシュ先頭2文字>/<ハッシュ><拡張子> に保存する。
+
+    どのコンテンツがどの画像を使っているか (マニフェスト) はコンテンツの "images" に、
+    参照数は KnowledgeStore の blobs テーブルにある。ファイル操作はブロッキングなので
+    イベントループからは asyncio.to_thread 経由で呼ぶこと。
+
+    ファイルの配置と削除は store.lock の中で行う。取り込んだばかりでまだエントリに保存されていない
+    画像は pending に数えておき、その間は参照数が0でも消さない (保存し終えたら release する)。
+    """
+
+    def __init__(self, store, root=BLOBS_DIR):
+        self.store = store
+        self.root = root
+        self.pending = {}  # ハッシュ -> 取り込み中の数
+        os.makedirs(self.root, exist_ok=True)
+        self._real_root = os.path.realpath(self.root)
+
+    def path(self, hash_, ext):
+        path = os.path.join(self.root, hash_[:2], f"{hash_}{ext}")
+        # 置き場の外 (../ など) を指すハッシュは、読むのも消すのも断る
+        if os.path.commonpath([self._real_root, os.path.realpath(path)]) != self._real_root:
+            raise ValueError(f"画像の置き場の外を指しています: {hash_}{ext}")
+        return path
+
+    def path_of(self, image):
+        return self.path(image["hash"], image.get("ext", ""))
+
+    def place(self, src_path, hash_, ext):
+        """ハッシュを確かめ済みのファイルを置き場に移して、保存し終えるまで消されないようにする。"""
+        dest = self.path(hash_, ext)
+        with self.store.lock:
+            if os.path.exists(dest):
+                # 同じ画像がもうある
+                os.remove(src_path)
+            else:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.move(src_path, dest)
+            self.pending[hash_] = self.pending.get(hash_, 0) + 1
+
+    def adopt(self, hash_, ext):
+        # すでに置き場にある画像を、取り込み中として押さえる。無ければ False
+        with self.store.lock:
+            if not os.path.exists(self.path(hash_, ext)): return False
+            self.pending[hash_] = self.pending.get(hash_, 0) + 1
+            return True
+
+    def release(self, images):
+        """place / adopt / ingest で押さえた画像 (マニフェストのリスト) を、保存し終えたので手放す。"""
+        with self.store.lock:
+            for img in image_refs({"images": images}):
+                n = self.pending.get(img["hash"], 0) - 1
+                if n > 0:
+                    self.pending[img["hash"]] = n
+                else:
+                    self.pending.pop(img["hash"], None)
+
+    def _put_blob(self, src_path, ext):
+        hash_, size = file_hash(src_path)
+        self.place(src_path, hash_, ext)
+        return {"hash": hash_, "ext": ext, "size": size}
+
+    def ingest(self, src_path, filename=None, optimized=None, keep_original=True):
+        """ファイルを取り込んでマニフェスト用の情報を返す。取り込んだ元ファイルは消す。
+
+        返した画像はエントリに保存し終えたら release すること。
+
+        optimized (縮小・再圧縮したファイル) があれば表示にはそちらを使う。
+        keep_original=False なら元の画像は保存せず、最適化したものだけを残す。
+        """
+        filename = filename or os.path.basename(src_path)
+        ext = os.path.splitext(filename)[1].lower()
+        if optimized is None:
+            return {**self._put_blob(src_path, ext), "filename": filename}
+
+        variant = self._put_blob(optimized, os.path.splitext(optimized)[1].lower())
+        if not keep_original:
+            # 差し替え時に同じ画像かどうかを比べられるよう、元のハッシュだけは覚えておく
+            source, _ = file_hash(src_path)
+            os.remove(src_path)
+            return {**variant, "filename": os.path.splitext(filename)[0] + variant["ext"], "source_hash": source}
+        return {**self._put_blob(src_path, ext), "filename": filename, "optimized": variant}
+
+    def serve(self, image):
+        """表示に使う (パス, ファイル名)。最適化したものがあればそちら。"""
+        variant = image.get("optimized")
+        if variant:
+            return self.path_of(variant), os.path.splitext(image.get("filename", "image"))[0] + variant["ext"]
+        path = self.path_of(image)
+        return path, image.get("filename") or os.path.basename(path)
+
+    def remove(self, orphans):
+        # 参照数が0になった画像だけを消す。その間に別のエントリが同じ画像を使い始めていたら残す
+        with self.store.lock:
+            for hash_, ext in orphans:
+                if self.pending.get(hash_) or self.store.refcount(hash_) > 0: continue
+                try:
+                    os.remove(self.path(hash_, ext))
+                except FileNotFoundError:
+                    pass
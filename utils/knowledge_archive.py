@@ -0,0 +1,199 @@
+import hashlib
+import io
+import json
+import os
+import re
+import tarfile
+import threading
+import time
+
+from utils.knowledge_store import KINDS, image_refs
+
+ARCHIVE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+BLOB_MEMBER = re.compile(r"^blobs/([0-9a-f]{64})(\.[0-9A-Za-z]{1,8})?$")
+BLOB_HASH = re.compile(r"^[0-9a-f]{64}$")
+BLOB_EXT = re.compile(r"^(\.[0-9A-Za-z]{1,8})?$")
+
+IMPORT_MODES = ("merge", "overwrite")  # merge: 同じ名前は今のものを残す / overwrite: アーカイブの内容で上書き
+
+# ------------------------------------------------------------------
+# 進み具合 (スレッドで書き込み、イベントループ側で読む)
+# ------------------------------------------------------------------
+class Progress:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage = "準備中"
+        self.done = 0
+        self.total = 0
+        self.bytes = 0
+
+    def start(self, stage, total):
+        with self._lock:
+            self.stage, self.done, self.total = stage, 0, total
+
+    def step(self, nbytes=0):
+        with self._lock:
+            self.done += 1
+            self.bytes += nbytes
+
+    def snapshot(self):
+        with self._lock:
+            return self.stage, self.done, self.total, self.bytes
+
+# ------------------------------------------------------------------
+# 書き出し / 読み込み (どちらもブロッキング。asyncio.to_thread 経由で呼ぶこと)
+# ------------------------------------------------------------------
+def valid_refs(value):
+    # マニフェストの画像の hash / ext はそのままファイルのパスになるので、置き場の形式のものしか受け付けない
+    if not isinstance(value, dict): return True
+    images = value.get("images") or []
+    if not isinstance(images, list) or not all(isinstance(img, dict) for img in images): return False
+    if not all(isinstance(img.get("optimized") or {}, dict) for img in images): return False
+    return all(
+        isinstance(img.get("hash"), str) and BLOB_HASH.match(img["hash"])
+        and isinstance(img.get("ext", ""), str) and BLOB_EXT.match(img.get("ext", ""))
+        for img in image_refs(value)
+    )
+
+def export_archive(store, images, guild_id, dest_path, progress=None):
+    """guild_id の全エントリと、参照している画像ファイルを tar.gz に書き出す。
+
+    画像は1ファイルずつファイルから直接アーカイブに流し込むので、全部をメモリに載せることはない。
+    """
+    progress = progress or Progress()
+    data = store.load_guild(guild_id)
+    entries = []
+    blobs = {}
+    for kind in KINDS:
+        for name, value in data.get(kind, {}).items():
+            if isinstance(value, dict):
+                # 送信済みのURLは元のBotのメッセージのものなので持っていかない
+                value = {k: v for k, v in value.items() if k != "image_urls"}
+            entries.append({"kind": kind, "name": name, "value": value})
+            for img in image_refs(value):
+                blobs[img["hash"]] = img.get("ext", "")
+
+    manifest = json.dumps({
+        "version": ARCHIVE_VERSION,
+        "exported_at": time.time(),
+        "entries": entries,
+    }, ensure_ascii=False).encode("utf-8")
+
+    os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+    tmp = dest_path + ".tmp"
+    missing = 0
+    with tarfile.open(tmp, "w:gz") as tar:
+        # 読み込み時に先に中身を確認できるよう、マニフェストを先頭に置く
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(manifest)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(manifest))
+
+        progress.start("画像を書き出し中", len(blobs))
+        for hash_, ext in blobs.items():
+            path = images.path(hash_, ext)
+            if not os.path.exists(path):
+                missing += 1
+                progress.step()
+                continue
+            tar.add(path, arcname=f"blobs/{hash_}{ext}", recursive=False)
+            progress.step(os.path.getsize(path))
+    os.replace(tmp, dest_path)
+    return {"entries": len(entries), "blobs": len(blobs) - missing, "missing": missing, "bytes": os.path.getsize(dest_path)}
+
+def import_archive(store, images, guild_id, src_path, mode="merge", progress=None):
+    """export_archive で作ったアーカイブを guild_id に取り込む。戻り値は件数などの集計。
+
+    画像はアーカイブから一時ファイルへ少しずつコピーし、ハッシュを確かめてから置き場に移す。
+    取り込むエントリが参照している画像だけを展開し、すでにある画像は展開しない。
+    """
+    if mode not in IMPORT_MODES: raise ValueError(f"mode は {IMPORT_MODES} のどれかです")
+    progress = progress or Progress()
+    result = {"added": 0, "updated": 0, "skipped": 0, "blobs": 0, "reused": 0, "bad": 0}
+
+    with tarfile.open(src_path, "r:*") as tar:
+        try:
+            manifest = json.load(tar.extractfile(MANIFEST_NAME))
+        except (KeyError, ValueError):
+            raise ValueError("knowledge のアーカイブではないようです (manifest.json がありません)")
+        if manifest.get("version") != ARCHIVE_VERSION:
+            raise ValueError(f"対応していないアーカイブの形式です (version {manifest.get('version')})")
+
+        current = store.load_guild(guild_id)
+        plan = []
+        for e in manifest.get("entries", []):
+            kind, name, value = e.get("kind"), e.get("name"), e.get("value")
+            if kind not in KINDS or not isinstance(name, str): continue
+            if not valid_refs(value):
+                result["bad"] += 1
+                continue
+            exists = name in current.get(kind, {})
+            if exists and mode == "merge":
+                result["skipped"] += 1
+                continue
+            plan.append((kind, name, value, exists))
+
+        # 使う画像だけを展開する
+        needed = {img["hash"]: img.get("ext", "") for _, _, value, _ in plan for img in image_refs(value)}
+        members = [m for m in tar.getmembers() if m.isfile() and BLOB_MEMBER.match(m.name)]
+        progress.start("画像を取り込み中", len(members))
+        bad = set()
+        extracted = set()
+        adopted = []  # 保存し終えるまで消されないよう押さえている画像
+        for member in members:
+            hash_, ext = BLOB_MEMBER.match(member.name).groups()
+            ext = ext or ""
+            if hash_ not in needed:
+                progress.step()
+                continue
+            if images.adopt(hash_, ext):
+                adopted.append({"hash": hash_, "ext": ext})
+                result["reused"] += 1
+                progress.step()
+                continue
+            if _extract_blob(tar, member, images, hash_, ext):
+                adopted.append({"hash": hash_, "ext": ext})
+                extracted.add((hash_, ext))
+                result["blobs"] += 1
+            else:
+                bad.add(hash_)
+            progress.step(member.size)
+
+    # 画像が足りない (壊れている・入っていない) エントリは取り込まない
+    available = lambda img: img["hash"] not in bad and os.path.exists(images.path(img["hash"], img.get("ext", "")))
+    progress.start("エントリを保存中", len(plan))
+    orphans = []
+    try:
+        for kind, name, value, exists in plan:
+            if not all(available(img) for img in image_refs(value)):
+                result["bad"] += 1
+                progress.step()
+                continue
+            orphans += store.put(guild_id, kind, name, value)
+            result["updated" if exists else "added"] += 1
+            progress.step()
+    finally:
+        images.release(adopted)
+        # 取り込まなかったエントリのためだけに展開した画像も消しておく (参照されているものは remove が残す)
+        orphans += list(extracted)
+        if orphans: images.remove(orphans)
+    return result
+
+def _extract_blob(tar, member, images, hash_, ext):
+    # アーカイブ内のファイル名 (ハッシュ) と中身が一致したものだけを置き場に入れる
+    src = tar.extractfile(member)
+    if src is None: return False
+    dest = images.path(hash_, ext)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = dest + ".part"
+    digest = hashlib.sha256()
+    with open(tmp, "wb") as f:
+        for block in iter(lambda: src.read(1024 * 1024), b""):
+            digest.update(block)
+            f.write(block)
+    if digest.hexdigest() != hash_:
+        os.remove(tmp)
+        return False
+    images.place(tmp, hash_, ext)
+    return True
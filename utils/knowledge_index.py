@@ -0,0 +1,137 @@
+import math
+import unicodedata
+from collections import Counter, defaultdict
+from utils.text import kata_to_hira, normalize_text, tokenize
+
+KIND_LABELS = {"macros": "マクロ", "strategies": "攻略ボード", "contents": "コンテンツ"}
+
+# ------------------------------------------------------------------
+# 登録済みナレッジ (マクロ・攻略ボード・コンテンツ) の転置インデックス
+# ------------------------------------------------------------------
+def entry_text(kind, value):
+    if kind == "contents":
+        return value.get("text", "") if isinstance(value, dict) else ""
+    return value or ""
+
+class KnowledgeIndex:
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)  # token -> {doc_id: 出現回数}
+        self.docs = {}                     # doc_id -> {"kind", "name", "text", "length", "name_tokens"}
+        self.total_length = 0
+
+    def add(self, kind, name, text):
+        doc_id = (kind, name)
+        if doc_id in self.docs:
+            if self.docs[doc_id]["text"] == text: return
+            self.remove(kind, name)
+
+        name_tokens = tokenize(name)
+        # 名前で引かれることが多いので、名前のトークンは本文より重く数える
+        tokens = name_tokens * 2 + tokenize(text)
+        for t, n in Counter(tokens).items():
+            self.postings[t][doc_id] = n
+        self.docs[doc_id] = {"kind": kind, "name": name, "text": text, "length": len(tokens), "name_tokens": set(name_tokens)}
+        self.total_length += len(tokens)
+
+    def remove(self, kind, name):
+        doc = self.docs.pop((kind, name), None)
+        if doc is None: return
+        self.total_length -= doc["length"]
+        for t in set(tokenize(name) + tokenize(doc["text"])):
+            posting = self.postings.get(t)
+            if posting is None: continue
+            posting.pop((kind, name), None)
+            if not posting: del self.postings[t]
+
+    def sync(self, data):
+        # 変わったものだけを入れ直す (保存のたびに呼んでも全件の再計算はしない)
+        current = set()
+        for kind in KIND_LABELS:
+            for name, value in data.get(kind, {}).items():
+                current.add((kind, name))
+                self.add(kind, name, entry_text(kind, value))
+        for kind, name in [d for d in self.docs if d not in current]:
+            self.remove(kind, name)
+
+    def search(self, query, limit=5, kinds=None):
+        query_tokens = set(tokenize(query))
+        n = len(self.docs)
+        if not query_tokens or n == 0: return []
+        avg_len = self.total_length / n or 1.0
+
+        scores = defaultdict(float)
+        for t in query_tokens:
+            posting = self.postings.get(t)
+            if not posting: continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                if kinds and doc_id[0] not in kinds: continue
+                length = self.docs[doc_id]["length"]
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_len))
+
+        hits = []
+        for doc_id, score in sorted(scores.items(), key=lambda x: -x[1])[:limit]:
+            doc = self.docs[doc_id]
+            hits.append({
+                "kind": doc["kind"],
+                "name": doc["name"],
+                "text": doc["text"],
+                "score": score,
+                # クエリのトークンのうち、名前に含まれている割合
+                "coverage": len(query_tokens & doc["name_tokens"]) / len(query_tokens),
+                # 名前のトークンのうち、クエリに含まれている割合 (名前に言及しているか)
+                "name_match": len(query_tokens & doc["name_tokens"]) / (len(doc["name_tokens"]) or 1),
+            })
+        return hits
+
+    def relevant(self, query, limit=3, min_name_match=0.5):
+        # プロンプトに添える候補。名前に触れているものだけに絞ってノイズを減らす
+        return [h for h in self.search(query, limit=limit * 2) if h["name_match"] >= min_name_match][:limit]
+
+    def confident(self, query, min_coverage=0.8):
+        # 質問がほぼ名前そのものを指していて、候補が1つに絞れるときだけ直接答える
+        hits = [h for h in self.search(query, limit=5) if h["name_match"] == 1.0 and h["coverage"] >= min_coverage]
+        return hits[0] if len(hits) == 1 else None
+
+    def __len__(self):
+        return len(self.docs)
+
+def format_snippet(hit, length=300):
+    text = hit["text"].strip()
+    if len(text) > length:
+        text = text[:length] + "…"
+    return f"[{KIND_LABELS.get(hit['kind'], hit['kind'])}] {hit['name']}\n{text}"
+
+def make_snippet(text, query, width=60):
+    """本文のうち、クエリに最初に一致したあたりを切り出して **太字** で強調する。"""
+    text = " ".join((text or "").split())
+    if not text: return ""
+    # 1文字ずつ正規化して、正規化後の位置から元の位置に戻せるようにする
+    norm = ""
+    origin = []
+    for i, c in enumerate(text):
+        n = kata_to_hira(unicodedata.normalize("NFKC", c)).lower()
+        norm += n
+        origin += [i] * len(n)
+
+    # まずは入力された語そのもの、見つからなければトークン単位で、いちばん前の一致を探す
+    best = None
+    for terms in (normalize_text(query).split(), set(tokenize(query))):
+        for t in terms:
+            pos = norm.find(t)
+            if pos >= 0 and (best is None or pos < best[0]):
+                best = (pos, pos + len(t))
+        if best is not None: break
+    if best is None:
+        return text[:width * 2] + ("…" if len(text) > width * 2 else "")
+
+    start, end = origin[best[0]], origin[best[1] - 1] + 1
+    left = max(0, start - width)
+    right = min(len(text), end + width)
+    return (
+        ("…" if left > 0 else "")
+        + text[left:start] + f"**{text[start:end]}**" + text[end:right]
+        + ("…" if right < len(text) else "")
+    )
@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+from utils.autocomplete import AutocompleteIndex
+from utils.cache import TTLCache
+from utils.knowledge_index import KnowledgeIndex, entry_text
+from utils.singleflight import SingleFlight
+
+# ------------------------------------------------------------------
+# 設定 (.env で上書きできる)
+# ------------------------------------------------------------------
+KNOWLEDGE_MAX_GUILDS = int(os.getenv("KNOWLEDGE_MAX_GUILDS", "20"))        # メモリに載せておくサーバー数
+KNOWLEDGE_IDLE_SECONDS = float(os.getenv("KNOWLEDGE_IDLE_SECONDS", "1800"))  # 使われないサーバーを降ろすまでの秒数
+
+# ------------------------------------------------------------------
+# 1サーバー分のマクロ・攻略ボード・コンテンツ
+# ------------------------------------------------------------------
+class KnowledgeShard:
+    def __init__(self, guild_id, data):
+        self.guild_id = guild_id
+        self.data = data
+        # /search や /chat から登録済みの情報を引くための索引
+        self.index = KnowledgeIndex()
+        self.index.sync(data)
+        # 名前の入力補完 (種類ごと)
+        self.autocomplete = {kind: AutocompleteIndex(entries.keys()) for kind, entries in data.items()}
+
+    def put(self, kind, name, value):
+        self.data[kind][name] = value
+        self.index.add(kind, name, entry_text(kind, value))
+        self.autocomplete[kind].add(name)
+        self.autocomplete[kind].touch(name)
+
+    def remove(self, kind, name):
+        self.data[kind].pop(name, None)
+        self.index.remove(kind, name)
+        self.autocomplete[kind].remove(name)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.data.values())
+
+class ShardCache:
+    """サーバーごとのデータを、最初に使われたときに読み込む。
+
+    しばらく使われていないサーバーや、KNOWLEDGE_MAX_GUILDS を超えた分はメモリから降ろす
+    (保存は1件ずつ済んでいるので、降ろすときに書き出すものは無い)。
+    loader(guild_id) -> KnowledgeShard はブロッキングで、スレッドで実行される。
+    """
+
+    def __init__(self, loader, max_guilds=KNOWLEDGE_MAX_GUILDS, idle_seconds=KNOWLEDGE_IDLE_SECONDS):
+        self.loader = loader
+        self.shards = TTLCache(max_entries=max_guilds, ttl=idle_seconds, sliding=True)
+        self.loading = SingleFlight()  # 同じサーバーを同時に読み込まない
+        self.loads = 0
+
+    async def get(self, guild_id):
+        shard = self.shards.get(guild_id)
+        if shard is not None: return shard
+        return await self.loading.do(guild_id, lambda: self._load(guild_id))
+
+    async def _load(self, guild_id):
+        shard = await asyncio.to_thread(self.loader, guild_id)
+        self.loads += 1
+        self.shards.set(guild_id, shard)
+        return shard
+
+    def resident(self, guild_id):
+        # 読み込み済みなら返す (読み込みはしない)
+        return self.shards.get(guild_id)
+
+    def invalidate(self, guild_id):
+        # まとめて書き換えたあとなど、次に使われたときに読み込み直させる
+        self.shards.pop(guild_id)
+
+    def sweep(self):
+        return self.shards.sweep()
+
+    def stats(self):
+        st = self.shards.stats()
+        return {**st, "loads": self.loads}
@@ -0,0 +1,202 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DATA_DIR = "data"
+KNOWLEDGE_DB = os.path.join(DATA_DIR, "knowledge.db")
+LEGACY_JSON = os.path.join(DATA_DIR, "knowledge.json")
+
+KINDS = ("macros", "strategies", "contents")
+
+# サーバーごとに分ける前のデータ (knowledge.json など) はこの番号に入れておき、
+# 起動時に KNOWLEDGE_HOME_GUILD のサーバーが、または管理者が /claimlegacyknowledge で引き取る
+LEGACY_GUILD = 0
+KNOWLEDGE_HOME_GUILD = int(os.getenv("KNOWLEDGE_HOME_GUILD", "0"))
+
+def image_refs(value):
+    # コンテンツが参照している画像ファイル (最適化した版も含む)。マクロ・攻略ボードや画像なしのものは空
+    if not isinstance(value, dict): return []
+    refs = []
+    for img in value.get("images") or []:
+        refs.append(img)
+        if img.get("optimized"): refs.append(img["optimized"])
+    return refs
+
+# ------------------------------------------------------------------
+# マクロ・攻略ボード・コンテンツの保存先 (SQLite / WAL)
+# ------------------------------------------------------------------
+class KnowledgeStore:
+    """1エントリ = 1行で保存する。追加・更新・削除はその行だけを書き換えるトランザクションになる。
+
+    行はサーバー (guild_id) ごとに分かれていて、読み込みもサーバー単位で行う。
+    画像の参照数 (blobs) は、同じ画像ファイルを共有するので全サーバー共通。
+
+    sqlite3はブロッキングなので、イベントループからは asyncio.to_thread 経由で呼ぶこと。
+    """
+
+    def __init__(self, path=KNOWLEDGE_DB, legacy_json=LEGACY_JSON):
+        self.path = path
+        self.legacy_json = legacy_json
+        # ImageStore も画像ファイルを置く・消すときにこのロックを持つので、入れ子にできる RLock にする
+        self._lock = threading.RLock()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL + synchronous=FULL: コミットのたびにWALをディスクへ書き切るので、
+        # Botが落ちても電源が落ちても、コミット済みの変更は必ず残る
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._create_entries()
+        # コンテンツの画像 (ハッシュで保存したファイル) を何件のコンテンツが参照しているか
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " hash TEXT PRIMARY KEY,"
+            " ext TEXT NOT NULL,"
+            " refcount INTEGER NOT NULL)"
+        )
+        self._conn.commit()
+        self._migrate_guilds()
+        self._migrate()
+
+    def _create_entries(self):
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " guild_id INTEGER NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (guild_id, kind, name))"
+        )
+
+    def _migrate_guilds(self):
+        # サーバーごとに分ける前の表 (guild_id なし) なら作り直して、全部 LEGACY_GUILD に入れる
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(entries)")]
+        if "guild_id" in columns: return
+        with self._lock, self._conn:
+            self._conn.execute("ALTER TABLE entries RENAME TO entries_old")
+            self._create_entries()
+            self._conn.execute(
+                "INSERT INTO entries (guild_id, kind, name, value, updated_at)"
+                " SELECT ?, kind, name, value, updated_at FROM entries_old ORDER BY rowid",
+                (LEGACY_GUILD,),
+            )
+            self._conn.execute("DROP TABLE entries_old")
+
+    def _migrate(self):
+        # 初回起動時だけ、今までの knowledge.json を取り込む
+        if not os.path.exists(self.legacy_json): return
+        if self._conn.execute("SELECT 1 FROM entries LIMIT 1").fetchone(): return
+
+        with open(self.legacy_json, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        now = time.time()
+        rows = [
+            (LEGACY_GUILD, kind, name, json.dumps(value, ensure_ascii=False), now)
+            for kind in KINDS
+            for name, value in data.get(kind, {}).items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO entries (guild_id, kind, name, value, updated_at) VALUES (?, ?, ?, ?, ?)", rows)
+        # 取り込んだ元ファイルは残しておく (二重に取り込まないよう名前だけ変える)
+        os.replace(self.legacy_json, self.legacy_json + ".migrated")
+        print(f"📦 knowledge.json から {len(rows)} 件をデータベースへ移行しました")
+
+    def claim_legacy(self, guild_id):
+        """まだどのサーバーにも属していないデータを guild_id のものにする。引き取った件数を返す。
+
+        検索や入力補完のついでに呼ばないこと (最初に触ったサーバーが全部持っていってしまう)。
+        """
+        if guild_id == LEGACY_GUILD: return 0
+        with self._lock, self._conn:
+            # すでに自分のデータがあるサーバーは引き取らない
+            if self._conn.execute("SELECT 1 FROM entries WHERE guild_id = ? LIMIT 1", (guild_id,)).fetchone(): return 0
+            cur = self._conn.execute("UPDATE entries SET guild_id = ? WHERE guild_id = ?", (guild_id, LEGACY_GUILD))
+            return cur.rowcount
+
+    def count(self, guild_id):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+
+    def load_guild(self, guild_id):
+        data = {kind: {} for kind in KINDS}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT kind, name, value FROM entries WHERE guild_id = ? ORDER BY rowid", (guild_id,)
+            ).fetchall()
+        for kind, name, value in rows:
+            data.setdefault(kind, {})[name] = json.loads(value)
+        return data
+
+    def _old_value(self, guild_id, kind, name):
+        row = self._conn.execute(
+            "SELECT value FROM entries WHERE guild_id = ? AND kind = ? AND name = ?", (guild_id, kind, name)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _update_refs(self, old_value, new_value):
+        # 画像の参照数を差分だけ増減する。0になった画像の (hash, ext) を返す
+        for img in image_refs(new_value):
+            self._conn.execute(
+                "INSERT INTO blobs (hash, ext, refcount) VALUES (?, ?, 1)"
+                " ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1",
+                (img["hash"], img.get("ext", "")),
+            )
+        orphans = []
+        for img in image_refs(old_value):
+            self._conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?", (img["hash"],))
+            row = self._conn.execute("SELECT ext, refcount FROM blobs WHERE hash = ?", (img["hash"],)).fetchone()
+            if row and row[1] <= 0:
+                self._conn.execute("DELETE FROM blobs WHERE hash = ?", (img["hash"],))
+                orphans.append((img["hash"], row[0]))
+        return orphans
+
+    def put(self, guild_id, kind, name, value):
+        """保存して、どこからも参照されなくなった画像の (hash, ext) のリストを返す。"""
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock, self._conn:
+            old_value = self._old_value(guild_id, kind, name)
+            self._conn.execute(
+                "INSERT INTO entries (guild_id, kind, name, value, updated_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(guild_id, kind, name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                (guild_id, kind, name, payload, time.time()),
+            )
+            return self._update_refs(old_value, value)
+
+    def set_image_urls(self, guild_id, name, expected, urls):
+        """コンテンツが expected のまま変わっていなければ、送信済みの画像URLを書き足した値を保存して返す。
+
+        画像を送っている間に /changecontent などで書き換えられていたら何もせず None を返す
+        (古い内容で上書きすると、新しい画像の参照数が減って消されてしまうため)。
+        """
+        value = {**expected, "image_urls": urls}
+        with self._lock, self._conn:
+            if self._old_value(guild_id, "contents", name) != expected: return None
+            # 画像は同じなので参照数は変わらない
+            self._conn.execute(
+                "UPDATE entries SET value = ?, updated_at = ? WHERE guild_id = ? AND kind = ? AND name = ?",
+                (json.dumps(value, ensure_ascii=False), time.time(), guild_id, "contents", name),
+            )
+        return value
+
+    def delete(self, guild_id, kind, name):
+        """削除して、どこからも参照されなくなった画像の (hash, ext) のリストを返す。"""
+        with self._lock, self._conn:
+            old_value = self._old_value(guild_id, kind, name)
+            self._conn.execute("DELETE FROM entries WHERE guild_id = ? AND kind = ? AND name = ?", (guild_id, kind, name))
+            return self._update_refs(old_value, None)
+
+    @property
+    def lock(self):
+        # 参照数の更新と、画像ファイルの配置・削除を同時に起こさないためのロック
+        return self._lock
+
+    def refcount(self, hash_):
+        with self._lock:
+            row = self._conn.execute("SELECT refcount FROM blobs WHERE hash = ?", (hash_,)).fetchone()
+        return row[0] if row else 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
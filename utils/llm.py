@@ -0,0 +1,318 @@
+import asyncio
+import os
+import random
+import time
+
+# ------------------------------------------------------------------
+# 設定 (.env で上書きできる)
+# ------------------------------------------------------------------
+CHAT_MODEL = os.getenv("GEMINI_CHAT_MODEL", "gemini-1.5-flash")      # /chat で使うモデル
+SEARCH_MODEL = os.getenv("GEMINI_SEARCH_MODEL", "gemini-1.5-flash")  # /search の要約で使うモデル
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")                     # "gemini" か "stub" (テスト用)
+
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))     # 同時リクエスト数の上限
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))          # 1回の呼び出し (ストリームなら1チャンク) の制限時間
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))     # 一時的なエラーでの再試行回数
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1")) # 再試行の待ち時間の基準 (秒)
+BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))   # 連続で何回失敗したら遮断するか
+BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "60"))  # 遮断してから試し直すまでの秒数
+
+# 再試行してよいHTTPステータス (レート制限・サーバー側の一時的なエラー)
+TRANSIENT_CODES = {429, 500, 502, 503, 504}
+
+# ------------------------------------------------------------------
+# 例外
+# ------------------------------------------------------------------
+class LLMError(Exception):
+    pass
+
+class LLMUnavailable(LLMError):
+    """APIキー未設定、または連続失敗で遮断中。すぐに諦めてよいエラー。"""
+
+class LLMTimeout(LLMError):
+    pass
+
+def is_transient(e):
+    if isinstance(e, (asyncio.TimeoutError, ConnectionError, LLMTimeout)): return True
+    # google.api_core の例外は code にHTTPステータスを持っている
+    return getattr(e, "code", None) in TRANSIENT_CODES
+
+# ------------------------------------------------------------------
+# バックエンド
+# ------------------------------------------------------------------
+class GeminiBackend:
+    def __init__(self, api_key):
+        import google.generativeai as genai
+        self.genai = genai
+        genai.configure(api_key=api_key)
+        self._models = {}  # モデル名 -> GenerativeModel (使い回す)
+
+    def model(self, name):
+        if name not in self._models:
+            self._models[name] = self.genai.GenerativeModel(name)
+        return self._models[name]
+
+    async def generate(self, model, contents, usage=None):
+        response = await self.model(model).generate_content_async(contents)
+        record_usage(usage, response)
+        return response.text
+
+    def generate_sync(self, model, contents, usage=None, timeout=None):
+        # ワーカープロセス用 (utils/worker.py)。timeout はAPIへのリクエスト自体の制限時間
+        options = {"timeout": timeout} if timeout else None
+        response = self.model(model).generate_content(contents, request_options=options)
+        record_usage(usage, response)
+        return response.text
+
+    async def stream(self, model, contents, usage=None):
+        response = await self.model(model).generate_content_async(contents, stream=True)
+        async for chunk in response:
+            # トークン数は最後のチャンクに入ってくる
+            record_usage(usage, chunk)
+            try:
+                text = chunk.text
+            except ValueError:
+                # 安全フィルタなどで本文が無いチャンク
+                continue
+            if text:
+                yield text
+
+class StubBackend:
+    """APIを呼ばずに決まった返事をするバックエンド (テスト・オフライン確認用)。"""
+
+    def __init__(self, reply=None, chunk_size=20):
+        self.reply = reply or (lambda model, contents: f"[stub:{model}] {last_text(contents)[:200]}")
+        self.chunk_size = chunk_size
+        self.calls = []
+
+    async def generate(self, model, contents, usage=None):
+        self.calls.append((model, contents))
+        return self.reply(model, contents)
+
+    async def stream(self, model, contents, usage=None):
+        text = await self.generate(model, contents, usage)
+        for i in range(0, len(text), self.chunk_size):
+            await asyncio.sleep(0)
+            yield text[i:i + self.chunk_size]
+
+def record_usage(usage, response):
+    meta = getattr(response, "usage_metadata", None)
+    if usage is None or meta is None: return
+    # ストリームでは累計値が届くので、足し込まずに最新の値で上書きする
+    usage["input_tokens"] = getattr(meta, "prompt_token_count", 0) or 0
+    usage["output_tokens"] = getattr(meta, "candidates_token_count", 0) or 0
+
+def merge_usage(total, call_usage):
+    # 1回の呼び出し分を、コマンド全体の集計 (metrics.Measurement.usage) に足す
+    if total is None: return
+    total["calls"] = total.get("calls", 0) + 1
+    for key in ("input_tokens", "output_tokens"):
+        total[key] = total.get(key, 0) + call_usage.get(key, 0)
+
+def last_text(contents):
+    if isinstance(contents, str): return contents
+    if not contents: return ""
+    last = contents[-1]
+    if isinstance(last, dict):
+        return "".join(str(p) for p in last.get("parts", []))
+    return str(last)
+
+# ------------------------------------------------------------------
+# サーキットブレーカー
+# ------------------------------------------------------------------
+class CircuitBreaker:
+    """一時的なエラー (is_transient) が続いたら遮断する。
+
+    安全フィルタや不正なリクエストなど、相手が応答できているエラーは数えない。
+    クールダウン後 (half-open) は試しの1件だけを通し、その結果で閉じるか遮断し直すかを決める。
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self.probe_started = None  # half-open で試しに通した1件の開始時刻
+
+    @property
+    def state(self):
+        if self.opened_at is None: return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown: return "half-open"
+        return "open"
+
+    def allow(self):
+        # 遮断中は即座に断る。クールダウン後は1件だけ試しに通す (half-open)
+        state = self.state
+        if state == "closed": return True
+        if state == "open": return False
+        now = time.monotonic()
+        # 試しの1件がキャンセルなどで結果を返さなかったときは、クールダウン分待ってから次を通す
+        if self.probe_started is not None and now - self.probe_started < self.cooldown: return False
+        self.probe_started = now
+        return True
+
+    def release(self):
+        # 試しの1件が、遮断に関係ないエラーで終わった (状態はそのまま)
+        self.probe_started = None
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.threshold:
+            if self.opened_at is None: self.trips += 1
+            self.opened_at = time.monotonic()
+        self.probe_started = None
+
+# ------------------------------------------------------------------
+# ゲートウェイ本体
+# ------------------------------------------------------------------
+class LLMGateway:
+    def __init__(self, backend, timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES,
+                 backoff_base=LLM_BACKOFF_BASE, concurrency=LLM_CONCURRENCY, breaker=None):
+        self.backend = backend
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.breaker = breaker or CircuitBreaker()
+
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+    @property
+    def available(self):
+        return self.backend is not None
+
+    def _check(self):
+        if self.backend is None:
+            self.rejected += 1
+            raise LLMUnavailable("GEMINI_API_KEY が設定されていません")
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise LLMUnavailable("Geminiへの接続が不安定なため、一時的に停止しています")
+
+    async def _backoff(self, attempt):
+        # 指数バックオフ + ジッター (同時に失敗した呼び出しが一斉に再試行しないように)
+        delay = self.backoff_base * (2 ** attempt)
+        await asyncio.sleep(random.uniform(0, delay))
+
+    def _wrap(self, e):
+        if isinstance(e, asyncio.TimeoutError):
+            return LLMTimeout(f"{self.timeout}秒以内に応答がありませんでした")
+        return e
+
+    def _failed(self, e, attempt):
+        # 遮断の判断に数えるのは一時的なエラーだけ (安全フィルタや400で全員を止めない)
+        if not is_transient(e):
+            self.breaker.release()
+            self.failures += 1
+            return False
+        self.breaker.record_failure()
+        # 遮断されたら再試行もしない (ここで allow() を呼ぶと試しの1件の枠を使ってしまう)
+        retry = attempt < self.max_retries and self.breaker.state == "closed"
+        if not retry:
+            self.failures += 1
+        else:
+            self.retries += 1
+        return retry
+
+    async def generate(self, contents, model=CHAT_MODEL, usage=None):
+        attempt = 0
+        while True:
+            self._check()
+            self.calls += 1
+            call_usage = {}
+            try:
+                async with self.semaphore:
+                    text = await asyncio.wait_for(self.backend.generate(model, contents, call_usage), self.timeout)
+                self.breaker.record_success()
+                return text
+            except Exception as e:
+                e = self._wrap(e)
+                if not self._failed(e, attempt):
+                    raise e
+            finally:
+                merge_usage(usage, call_usage)
+            await self._backoff(attempt)
+            attempt += 1
+
+    async def stream(self, contents, model=CHAT_MODEL, usage=None):
+        # 最初のチャンクが届く前の失敗だけ再試行する (途中まで表示したものをやり直さない)
+        attempt = 0
+        while True:
+            self._check()
+            self.calls += 1
+            started = False
+            call_usage = {}
+            try:
+                async with self.semaphore:
+                    chunks = self.backend.stream(model, contents, call_usage).__aiter__()
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                        except StopAsyncIteration:
+                            break
+                        started = True
+                        yield chunk
+                self.breaker.record_success()
+                return
+            except Exception as e:
+                e = self._wrap(e)
+                if started:
+                    if is_transient(e): self.breaker.record_failure()
+                    else: self.breaker.release()
+                    self.failures += 1
+                    raise e
+                if not self._failed(e, attempt):
+                    raise e
+            finally:
+                merge_usage(usage, call_usage)
+            await self._backoff(attempt)
+            attempt += 1
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "breaker": self.breaker.state,
+            "breaker_trips": self.breaker.trips,
+        }
+
+_gateway = None
+
+def get_gateway():
+    """Bot全体で1つのゲートウェイ (と1つのクライアント) を共有する。"""
+    from utils.worker import ProcessBackend, get_worker_pool
+    global _gateway
+    if _gateway is None:
+        if LLM_BACKEND == "stub":
+            backend = StubBackend()
+        else:
+            api_key = os.getenv("GEMINI_API_KEY")
+            if not api_key:
+                print("⚠️ 警告: GEMINI_API_KEY が見つかりません！.envを確認してください。")
+                backend = None
+            elif get_worker_pool() is not None:
+                # 生成はワーカープロセスで行う (AI_WORKER_PROCESSES)
+                backend = ProcessBackend(get_worker_pool())
+            else:
+                backend = GeminiBackend(api_key)
+        _gateway = LLMGateway(backend)
+    return _gateway
+
+def error_message(e):
+    # ユーザーに見せるエラー文 (生の例外はターミナルにだけ出す)
+    if isinstance(e, LLMUnavailable):
+        return f"ごめん、今はAIが使えないみたい…（{e}）少し時間をおいて試してね。"
+    if isinstance(e, LLMTimeout):
+        return "ごめん、AIの返事が遅すぎたので諦めちゃった…もう一度試してみてね。"
+    return "ごめん、ちょっとエラーが出ちゃったみたい。もう一度試してみてね。"
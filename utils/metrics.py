@@ -0,0 +1,164 @@
+import asyncio
+import json
+import math
+import os
+import time
+
+DATA_DIR = "data"
+USAGE_FILE = os.path.join(DATA_DIR, "llm_usage.json")
+
+BUCKET_SECONDS = 60                 # 集計の単位 (1分ごと)
+RETENTION_SECONDS = 7 * 24 * 3600   # 保存しておく期間
+MAX_SAMPLES = 200                   # 1バケットに残すレイテンシの件数 (パーセンタイル用)
+SAVE_INTERVAL = 60                  # ファイルに書き出す最短間隔 (秒)
+
+WINDOWS = [("1時間", 3600), ("24時間", 24 * 3600), ("7日", 7 * 24 * 3600)]
+
+def percentile(sorted_values, p):
+    # 最近順位法 (nearest-rank): 全体の p% 以上をカバーする最小の値
+    if not sorted_values: return None
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+USER_FIELDS = ("requests", "llm_calls", "input_tokens", "output_tokens")
+
+def user_counts(value):
+    # 以前の形式 (コマンドごとの回数だけ) も読めるようにする
+    if isinstance(value, dict): return value
+    return {"requests": value, "llm_calls": 0, "input_tokens": 0, "output_tokens": 0}
+
+# ------------------------------------------------------------------
+# 1回分の計測
+# ------------------------------------------------------------------
+class Measurement:
+    def __init__(self, meter, command, user_id):
+        self.meter = meter
+        self.command = command
+        self.user_id = user_id
+        # LLMゲートウェイに渡すと、分かる範囲でトークン数を書き込んでくれる
+        self.usage = {"calls": 0, "input_tokens": 0, "output_tokens": 0}
+
+    async def __aenter__(self):
+        self.started = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        ok = exc_type is None
+        self.meter.record(self.command, self.user_id, time.monotonic() - self.started, ok, self.usage)
+        return False
+
+# ------------------------------------------------------------------
+# LLMコマンドの利用量 (回数・トークン・レイテンシ・エラー率) を分単位で集計する
+# ------------------------------------------------------------------
+class UsageMeter:
+    def __init__(self, path=USAGE_FILE):
+        self.path = path
+        # バケット開始時刻 -> {"commands": {command: 集計}, "users": {user_id: {command: {回数・トークン}}}}
+        self.buckets = {}
+        self._last_save = time.monotonic()
+        self._saving = None
+        self.load()
+
+    def track(self, command, user_id):
+        return Measurement(self, command, user_id)
+
+    def record(self, command, user_id, latency, ok, usage=None):
+        usage = usage or {}
+        key = int(time.time()) // BUCKET_SECONDS * BUCKET_SECONDS
+        bucket = self.buckets.setdefault(key, {"commands": {}, "users": {}})
+        c = bucket["commands"].setdefault(command, {
+            "requests": 0, "errors": 0, "llm_calls": 0,
+            "input_tokens": 0, "output_tokens": 0, "latencies": [],
+        })
+        c["requests"] += 1
+        if not ok: c["errors"] += 1
+        c["llm_calls"] += usage.get("calls", 0)
+        c["input_tokens"] += usage.get("input_tokens", 0)
+        c["output_tokens"] += usage.get("output_tokens", 0)
+        if len(c["latencies"]) < MAX_SAMPLES:
+            c["latencies"].append(round(latency, 3))
+
+        u = bucket["users"].setdefault(str(user_id), {})
+        per_user = u[command] = user_counts(u.get(command, 0))
+        per_user["requests"] += 1
+        per_user["llm_calls"] += usage.get("calls", 0)
+        per_user["input_tokens"] += usage.get("input_tokens", 0)
+        per_user["output_tokens"] += usage.get("output_tokens", 0)
+
+        self._maybe_save()
+
+    def _prune(self):
+        oldest = time.time() - RETENTION_SECONDS
+        for key in [k for k in self.buckets if k < oldest]:
+            del self.buckets[key]
+
+    def summary(self, seconds):
+        """直近 seconds 秒のコマンド別の集計と、ユーザー別・コマンド別の回数とトークン数を返す。"""
+        since = time.time() - seconds
+        commands = {}
+        users = {}
+        for key, bucket in self.buckets.items():
+            if key + BUCKET_SECONDS <= since: continue
+            for name, c in bucket["commands"].items():
+                total = commands.setdefault(name, {
+                    "requests": 0, "errors": 0, "llm_calls": 0,
+                    "input_tokens": 0, "output_tokens": 0, "latencies": [],
+                })
+                for field in ("requests", "errors", "llm_calls", "input_tokens", "output_tokens"):
+                    total[field] += c[field]
+                total["latencies"] += c["latencies"]
+            for user_id, counts in bucket["users"].items():
+                per_user = users.setdefault(user_id, {})
+                for name, n in counts.items():
+                    total = per_user.setdefault(name, dict.fromkeys(USER_FIELDS, 0))
+                    for field, value in user_counts(n).items():
+                        total[field] += value
+
+        for total in commands.values():
+            lat = sorted(total.pop("latencies"))
+            total["p50"] = percentile(lat, 50)
+            total["p95"] = percentile(lat, 95)
+            total["p99"] = percentile(lat, 99)
+            total["error_rate"] = total["errors"] / total["requests"] if total["requests"] else 0.0
+        return commands, users
+
+    # --- 保存 ---
+    def load(self):
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            self.buckets = {int(k): v for k, v in raw.get("buckets", {}).items()}
+            self._prune()
+        except Exception as e:
+            print(f"⚠️ 利用状況の読み込みに失敗しました: {e}")
+
+    def _dump(self):
+        self._prune()
+        return json.dumps({"buckets": {str(k): v for k, v in self.buckets.items()}}, ensure_ascii=False)
+
+    def _write(self, payload):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp, self.path)
+
+    def _maybe_save(self):
+        now = time.monotonic()
+        if now - self._last_save < SAVE_INTERVAL: return
+        if self._saving is not None and not self._saving.done(): return
+        self._last_save = now
+        # 中身はループ上で固めてから、書き込みだけスレッドで行う
+        self._saving = asyncio.ensure_future(asyncio.to_thread(self._write, self._dump()))
+
+    def save(self):
+        self._write(self._dump())
+
+_meter = None
+
+def get_meter():
+    global _meter
+    if _meter is None:
+        _meter = UsageMeter()
+    return _meter
@@ -0,0 +1,37 @@
+import math
+from collections import Counter
+from utils.text import tokenize
+
+# ------------------------------------------------------------------
+# BM25による並べ替え
+# ------------------------------------------------------------------
+def bm25_scores(query_tokens, docs_tokens, k1=1.5, b=0.75):
+    """各文書 (トークンのリスト) の、クエリに対するBM25スコアを返す。"""
+    n = len(docs_tokens)
+    if n == 0: return []
+    avg_len = sum(len(d) for d in docs_tokens) / n or 1.0
+    df = Counter()
+    for d in docs_tokens:
+        df.update(set(d))
+
+    scores = []
+    query_terms = set(query_tokens)
+    for d in docs_tokens:
+        tf = Counter(d)
+        score = 0.0
+        for t in query_terms:
+            if t not in tf: continue
+            idf = math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5))
+            score += idf * tf[t] * (k1 + 1) / (tf[t] + k1 * (1 - b + b * len(d) / avg_len))
+        scores.append(score)
+    return scores
+
+def rerank(query, results, top_k=3, title_weight=2):
+    """Web検索の結果をタイトルと本文でスコアリングし、上位 top_k 件を返す。"""
+    if not results: return []
+    # タイトルの一致を重く見るため、タイトルのトークンは重ねて数える
+    docs = [tokenize(r.get("title", "")) * title_weight + tokenize(r.get("body", "")) for r in results]
+    scores = bm25_scores(tokenize(query), docs)
+    # 同点なら元の検索順を保つ
+    order = sorted(range(len(results)), key=lambda i: (-scores[i], i))
+    return [results[i] for i in order[:top_k]]
@@ -0,0 +1,238 @@
+import asyncio
+import contextlib
+import os
+import time
+from collections import OrderedDict, deque
+
+# ------------------------------------------------------------------
+# 設定 (.env で上書きできる)
+# ------------------------------------------------------------------
+LLM_GLOBAL_PER_MIN = float(os.getenv("LLM_GLOBAL_PER_MIN", "30"))  # Bot全体で1分あたりに通す回数
+LLM_GLOBAL_BURST = int(os.getenv("LLM_GLOBAL_BURST", "10"))        # Bot全体でまとめて通せる回数
+LLM_USER_PER_MIN = float(os.getenv("LLM_USER_PER_MIN", "4"))       # 1人あたり1分に通す回数
+LLM_USER_BURST = int(os.getenv("LLM_USER_BURST", "2"))             # 1人あたりまとめて通せる回数
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "20"))              # 順番待ちできる最大件数
+
+class QueueFull(Exception):
+    pass
+
+# ------------------------------------------------------------------
+# トークンバケット
+# ------------------------------------------------------------------
+class TokenBucket:
+    def __init__(self, per_min, burst):
+        self.rate = per_min / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self):
+        self._refill()
+        return self.tokens >= 1
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def wait_time(self):
+        self._refill()
+        if self.tokens >= 1: return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+# ------------------------------------------------------------------
+# 全体 + ユーザーごとの制限と、ユーザー間で公平な順番待ち
+# ------------------------------------------------------------------
+class Ticket:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.granted = asyncio.get_running_loop().create_future()
+
+class FairLimiter:
+    """LLMを使うコマンドの前に置く制限。
+
+    - 全体とユーザーごとのトークンバケットの両方に空きがあるときだけ通す
+    - 同じユーザーの呼び出しは1件ずつ (前のものが終わるまで次を通さない)
+    - 待ちはユーザーごとの列にためて、ユーザー間を順番に回して通す (連投した人が列を占有しない)
+    """
+
+    def __init__(self, global_per_min=LLM_GLOBAL_PER_MIN, global_burst=LLM_GLOBAL_BURST,
+                 user_per_min=LLM_USER_PER_MIN, user_burst=LLM_USER_BURST, max_queue=LLM_QUEUE_MAX):
+        self.global_bucket = TokenBucket(global_per_min, global_burst)
+        self.user_per_min = user_per_min
+        self.user_burst = user_burst
+        self.max_queue = max_queue
+        self.user_buckets = {}        # user_id -> TokenBucket
+        self.queues = OrderedDict()   # user_id -> deque[Ticket] (先頭から順に回す)
+        self.active = set()           # 実行中のユーザー
+        self.waiting = 0
+        self._timer = None
+        self._last_prune = time.monotonic()
+
+        self.granted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def _bucket(self, user_id):
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self.user_buckets[user_id] = TokenBucket(self.user_per_min, self.user_burst)
+        return bucket
+
+    def enqueue(self, user_id):
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull("順番待ちがいっぱいです")
+        ticket = Ticket(user_id)
+        self.queues.setdefault(user_id, deque()).append(ticket)
+        self.waiting += 1
+        self._dispatch()
+        if not ticket.granted.done():
+            self.queued += 1
+        return ticket
+
+    def position(self, ticket):
+        # 自分より先に通りそうな件数 + 1 の目安 (ユーザー間を1件ずつ回す前提で数える)
+        queue = self.queues.get(ticket.user_id)
+        if ticket.granted.done() or not queue or ticket not in queue: return 0
+        mine = queue.index(ticket)  # 自分の列の何周目で通るか
+        ahead = mine
+        before_me = True
+        for user_id, q in self.queues.items():
+            if user_id == ticket.user_id:
+                before_me = False
+                continue
+            ahead += min(len(q), mine)
+            if before_me and len(q) > mine: ahead += 1
+        return ahead + 1
+
+    def cancel(self, ticket):
+        queue = self.queues.get(ticket.user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self.waiting -= 1
+            if not queue: del self.queues[ticket.user_id]
+        if not ticket.granted.done():
+            ticket.granted.cancel()
+
+    def release(self, ticket):
+        self.active.discard(ticket.user_id)
+        self._dispatch()
+
+    def _dispatch(self):
+        wait = None
+        # 先頭のユーザーから1件ずつ見て、通せるものを通す
+        for user_id in list(self.queues):
+            if user_id in self.active: continue
+            bucket = self._bucket(user_id)
+            if not bucket.ready():
+                w = bucket.wait_time()
+                wait = w if wait is None else min(wait, w)
+                continue
+            if not self.global_bucket.ready():
+                w = self.global_bucket.wait_time()
+                wait = w if wait is None else min(wait, w)
+                break
+
+            queue = self.queues.pop(user_id)
+            ticket = queue.popleft()
+            # まだ待ちがあれば列の最後に回す (ラウンドロビン)
+            if queue: self.queues[user_id] = queue
+            self.waiting -= 1
+            if ticket.granted.cancelled(): continue
+
+            bucket.take()
+            self.global_bucket.take()
+            self.active.add(user_id)
+            self.granted += 1
+            ticket.granted.set_result(True)
+
+        # バケットが空くのを待っている人がいれば、その頃にもう一度見る
+        if wait is not None and self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(wait, self._on_timer)
+        self._prune()
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _prune(self):
+        # しばらく使われずに満タンに戻ったバケットは捨てる
+        now = time.monotonic()
+        if now - self._last_prune < 60: return
+        self._last_prune = now
+        for user_id in [u for u, b in self.user_buckets.items() if b.full() and u not in self.active and u not in self.queues]:
+            del self.user_buckets[user_id]
+
+    def stats(self):
+        return {
+            "granted": self.granted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "waiting": self.waiting,
+            "active": len(self.active),
+        }
+
+    async def run(self, user_id, on_queued=None):
+        """順番が来るまで待つ。待つことになったら on_queued(位置) を呼ぶ。終わったら release すること。"""
+        ticket = self.enqueue(user_id)
+        last = None
+        try:
+            while not ticket.granted.done():
+                pos = self.position(ticket)
+                if on_queued and pos != last:
+                    last = pos
+                    await on_queued(pos)
+                # 位置の表示を更新するため、ときどき起きる
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.granted), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self.cancel(ticket)
+            if ticket.granted.done() and not ticket.granted.cancelled():
+                self.release(ticket)
+            raise
+        return ticket
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, on_queued=None):
+        ticket = await self.run(user_id, on_queued)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+# ------------------------------------------------------------------
+# 順番待ちの表示 (deferした応答を書き換える)
+# ------------------------------------------------------------------
+class QueueNotice:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.shown = False
+
+    async def __call__(self, position):
+        self.shown = True
+        await self.interaction.edit_original_response(content=f"⏳ 混み合っているので順番待ち中… (いま {position} 番目)")
+
+    async def done(self):
+        if self.shown:
+            await self.interaction.edit_original_response(content="✅ 順番が来たよ！")
+
+_limiter = None
+
+def get_limiter():
+    """LLMを使うコマンド全体で1つの制限を共有する。"""
+    global _limiter
+    if _limiter is None:
+        _limiter = FairLimiter()
+    return _limiter
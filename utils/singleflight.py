@@ -0,0 +1,25 @@
+import asyncio
+
+# ------------------------------------------------------------------
+# 同じキーの処理が実行中なら、その結果を待って共有する
+# ------------------------------------------------------------------
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}  # key -> asyncio.Task
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key, factory):
+        task = self._calls.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._calls.pop(key, None) if self._calls.get(key) is t else None)
+        else:
+            self.shared += 1
+        # 待っている1人がキャンセルされても、共有しているタスク自体は止めない
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,99 @@
+import os
+import shutil
+import time
+
+# ------------------------------------------------------------------
+# 設定 (.env で上書きできる)
+# ------------------------------------------------------------------
+TEMP_MAX_AGE = float(os.getenv("TEMP_MAX_AGE", "3600"))                          # これより古い一時フォルダは消す (秒)
+TEMP_MAX_BYTES = int(os.getenv("TEMP_MAX_BYTES", str(200 * 1024 * 1024)))        # 一時フォルダ全体の上限
+TEMP_SWEEP_MINUTES = float(os.getenv("TEMP_SWEEP_MINUTES", "10"))                # 見回りの間隔 (分)
+
+def folder_info(path):
+    # (合計サイズ, 最後に書き込まれた時刻)
+    size = 0
+    mtime = os.path.getmtime(path)
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                st = os.stat(os.path.join(root, f))
+            except FileNotFoundError:
+                continue
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime)
+    return size, mtime
+
+# ------------------------------------------------------------------
+# data/temp に残った一時フォルダの掃除
+# ------------------------------------------------------------------
+class TempJanitor:
+    """確認ボタンが押されないまま残った /addcontent・/changecontent の一時フォルダを消す。
+
+    - TEMP_MAX_AGE より古いものは消す
+    - 全体が TEMP_MAX_BYTES を超えていたら、古いものから上限に収まるまで消す
+    確認待ちのフォルダ (active) には触らない。ファイル操作はブロッキングなので
+    イベントループからは asyncio.to_thread 経由で呼ぶこと。
+    """
+
+    def __init__(self, root, max_age=TEMP_MAX_AGE, max_bytes=TEMP_MAX_BYTES):
+        self.root = root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.sweeps = 0
+        self.removed = 0
+        self.reclaimed = 0
+
+    def scan(self):
+        folders = []
+        if not os.path.isdir(self.root): return folders
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path): continue
+            try:
+                size, mtime = folder_info(path)
+            except FileNotFoundError:
+                continue
+            folders.append((path, size, mtime))
+        return folders
+
+    def sweep(self, active=(), max_age=None):
+        """消したフォルダの数と、空いたバイト数を返す。"""
+        max_age = self.max_age if max_age is None else max_age
+        active = {os.path.normpath(p) for p in active}
+        now = time.time()
+        folders = sorted(self.scan(), key=lambda f: f[2])  # 古い順
+        total = sum(size for _, size, _ in folders)
+
+        removed = 0
+        reclaimed = 0
+        for path, size, mtime in folders:
+            if os.path.normpath(path) in active: continue
+            if now - mtime < max_age and total <= self.max_bytes: continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+            reclaimed += size
+
+        self.sweeps += 1
+        self.removed += removed
+        self.reclaimed += reclaimed
+        return removed, reclaimed
+
+    def remove(self, path):
+        # 確認ビューが時間切れになったときなど、1件だけすぐ消す
+        if not path or not os.path.isdir(path): return 0
+        size, _ = folder_info(path)
+        shutil.rmtree(path, ignore_errors=True)
+        self.removed += 1
+        self.reclaimed += size
+        return size
+
+    def stats(self):
+        folders = self.scan()
+        return {
+            "folders": len(folders),
+            "bytes": sum(size for _, size, _ in folders),
+            "sweeps": self.sweeps,
+            "removed": self.removed,
+            "reclaimed": self.reclaimed,
+        }
@@ -0,0 +1,65 @@
+import re
+import unicodedata
+
+_SPACES = re.compile(r"\s+")
+
+MESSAGE_LIMIT = 1900  # 1メッセージに入れる最大文字数 (Discordの上限2000に余裕を持たせる)
+
+# ------------------------------------------------------------------
+# 表記ゆれの吸収
+# ------------------------------------------------------------------
+def kata_to_hira(text):
+    # カタカナ (ァ〜ヶ) をひらがなに寄せる。長音符などはそのまま
+    return "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in text)
+
+def normalize_text(text):
+    """全角/半角・カタカナ/ひらがな・大文字/小文字・空白の違いをならす。"""
+    text = unicodedata.normalize("NFKC", text or "")
+    text = kata_to_hira(text).lower()
+    return _SPACES.sub(" ", text).strip()
+
+_WORD = re.compile(r"[a-z0-9]+|[^\sa-z0-9]+")
+_PUNCT = re.compile(r"[\W_]+")
+
+def tokenize(text):
+    """日本語向けの簡易トークナイズ。
+
+    英数字は単語ごと、それ以外 (かな・漢字など) は文字の2-gramに分ける。
+    分かち書きの辞書が無くても部分一致で引っかかるようにするため。
+    """
+    tokens = []
+    for part in _WORD.findall(normalize_text(text)):
+        if part.isascii():
+            tokens.append(part)
+            continue
+        part = _PUNCT.sub("", part)
+        if len(part) == 1:
+            tokens.append(part)
+        else:
+            tokens += [part[i:i + 2] for i in range(len(part) - 1)]
+    return tokens
+
+# ------------------------------------------------------------------
+# Discordのメッセージ分割
+# ------------------------------------------------------------------
+def split_message(text, limit=MESSAGE_LIMIT):
+    """limit 文字以内のメッセージに分ける。なるべく改行の位置で区切り、コードブロックは閉じてから次に続ける。"""
+    pages = []
+    fence = None  # 前のページから続いているコードブロックの開き (```text など)
+    while text:
+        head = f"{fence}\n" if fence else ""
+        if len(head) + len(text) <= limit:
+            page, text = head + text, ""
+        else:
+            room = limit - len(head) - 4  # 閉じるための "\n```" の分を空けておく
+            cut = text.rfind("\n", 0, room)
+            if cut <= 0: cut = room
+            page, text = head + text[:cut], text[cut:].lstrip("\n")
+        fence = None
+        if page.count("```") % 2:
+            # 閉じていないコードブロックは、このページで閉じて次のページで開き直す
+            opener = re.match(r"```\w{0,20}$", page[page.rindex("```"):].split("\n", 1)[0])
+            fence = opener.group(0) if opener else "```"
+            page += "\n```"
+        pages.append(page)
+    return pages
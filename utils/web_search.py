@@ -0,0 +1,98 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
+from utils.rank import rerank
+
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "8"))       # 1クエリあたりの制限時間 (秒)
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "4"))         # 検索を実行するスレッド数
+SEARCH_FANOUT = os.getenv("SEARCH_FANOUT", "0") == "1"         # 複数の言い換えで並列に検索するか
+
+# ------------------------------------------------------------------
+# 検索バックエンド
+# ------------------------------------------------------------------
+class DDGSBackend:
+    """DuckDuckGo検索。text(query, max_results) が {"title", "href", "body"} のリストを返す。
+
+    ブロッキングなのでイベントループ上では直接呼ばないこと。
+    """
+
+    def text(self, query, max_results):
+        # 使うときだけ読み込む (差し替え用の偽バックエンドではライブラリ不要)
+        from duckduckgo_search import DDGS
+        with DDGS() as ddgs:
+            return list(ddgs.text(query, region='jp-jp', max_results=max_results))
+
+def query_variants(query, fanout=SEARCH_FANOUT):
+    variants = [f"{query} FF14"]
+    if fanout:
+        variants += [
+            f"{query} site:wikiwiki.jp/ff14",                  # 日本語攻略Wiki
+            f"{query} site:jp.finalfantasyxiv.com/lodestone",  # ロドスト
+        ]
+    return variants
+
+def url_key(url):
+    # 末尾のスラッシュやフラグメントの違いは同じページとみなす
+    parts = urlsplit(url or "")
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), parts.query, ""))
+
+def merge_results(result_lists):
+    merged = []
+    seen = set()
+    for results in result_lists:
+        for r in results:
+            key = url_key(r.get("href"))
+            if key in seen: continue
+            seen.add(key)
+            merged.append(r)
+    return merged
+
+# ------------------------------------------------------------------
+# イベントループを止めずに検索する
+# ------------------------------------------------------------------
+class WebSearcher:
+    def __init__(self, backend=None, timeout=SEARCH_TIMEOUT, max_workers=SEARCH_WORKERS, fanout=SEARCH_FANOUT):
+        self.backend = backend or DDGSBackend()
+        self.timeout = timeout
+        self.fanout = fanout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="websearch")
+        self.timeouts = 0
+
+    async def search_one(self, query, max_results):
+        """結果のリストを返す。タイムアウトしたときは None (「0件だった」と区別するため)。"""
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, self.backend.text, query, max_results)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            # スレッド自体は止められないが、待つのはやめて結果を捨てる
+            self.timeouts += 1
+            print(f"⚠️ Web検索がタイムアウトしました ({self.timeout}秒): {query}")
+            return None
+
+    async def search(self, query, max_results=3):
+        """(結果, complete) を返す。complete は全部の言い換えがタイムアウト・エラーなしで終わったかどうか。
+
+        一部が欠けた結果はその場では使ってよいが、キャッシュしてはいけない。
+        """
+        variants = query_variants(query, self.fanout)
+        outcomes = await asyncio.gather(*[self.search_one(v, max_results) for v in variants], return_exceptions=True)
+
+        result_lists = [o for o in outcomes if isinstance(o, list)]
+        errors = [o for o in outcomes if isinstance(o, BaseException)]
+        for e in errors:
+            print(f"⚠️ Web検索エラー: {e}")
+        # 全部失敗したときだけエラーにする (一部でも取れていればそれを使う)
+        if errors and not result_lists:
+            raise errors[0]
+        complete = len(result_lists) == len(variants)
+        return merge_results(result_lists), complete
+
+    async def search_ranked(self, query, max_results, top_k):
+        # 広めに集めて、手元で並べ替えた上位だけを返す
+        results, complete = await self.search(query, max_results)
+        return rerank(query, results, top_k=top_k), complete
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,131 @@
+import asyncio
+import atexit
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.llm import LLM_TIMEOUT
+
+# 0 のときは今まで通りBotと同じプロセスで動かす
+AI_WORKER_PROCESSES = int(os.getenv("AI_WORKER_PROCESSES", "0"))
+
+# ------------------------------------------------------------------
+# ワーカープロセス側 (ここから下の _ で始まる関数は子プロセスで実行される)
+# ------------------------------------------------------------------
+_backend = None
+_searcher = None
+
+def _init_worker():
+    global _backend, _searcher
+    from utils.llm import GeminiBackend
+    from utils.web_search import WebSearcher
+    api_key = os.getenv("GEMINI_API_KEY")
+    _backend = GeminiBackend(api_key) if api_key else None
+    _searcher = WebSearcher()
+
+def _job_generate(model, contents, timeout=None):
+    if _backend is None:
+        raise RuntimeError("GEMINI_API_KEY が設定されていません")
+    usage = {}
+    # 子プロセスにはイベントループが無いので同期APIで呼ぶ。
+    # Bot側で待つのをやめてもこちらは止まらないので、APIの呼び出しにも同じ制限時間を付けておく
+    text = _backend.generate_sync(model, contents, usage, timeout)
+    return text, usage
+
+def _job_search(query, max_results, top_k):
+    results, complete = asyncio.run(_searcher.search_ranked(query, max_results, top_k))
+    return results, complete, _searcher.timeouts
+
+# ------------------------------------------------------------------
+# Bot側
+# ------------------------------------------------------------------
+class WorkerPool:
+    """LLMとWeb検索の処理を別プロセスに投げる。
+
+    ゲートウェイのハートビートやボタン操作が、AIの重い処理 (プロンプト組み立て・並べ替え・JSON処理) と
+    同じGILを取り合わないようにするため。ジョブと結果はプロセス間のキューでやり取りされる。
+
+    submit を待っている側がタイムアウトやキャンセルで待つのをやめても、子プロセスで走り始めたジョブは
+    最後まで動き続ける (プロセスのジョブは途中で止められない)。そのためジョブ側にも制限時間を渡すこと。
+    子プロセスが落ちてプールが壊れたときは、作り直して1回だけやり直す。
+    """
+
+    def __init__(self, processes=AI_WORKER_PROCESSES):
+        self.processes = processes
+        self.jobs = 0
+        self.restarts = 0
+        self.executor = self._new_executor()
+        atexit.register(self.shutdown)
+
+    def _new_executor(self):
+        # Botのスレッドやイベントループを引き継がないよう、fork ではなく spawn で起動する
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+    def _restart(self, broken):
+        # 同時に失敗したジョブが何度も作り直さないよう、壊れたものがまだ使われているときだけ作り直す
+        if self.executor is not broken: return
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._new_executor()
+        self.restarts += 1
+        print("⚠️ ワーカープロセスが落ちたので、プールを作り直しました。")
+
+    async def submit(self, fn, *args):
+        self.jobs += 1
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            return await loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            self._restart(executor)
+            return await loop.run_in_executor(self.executor, fn, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class ProcessBackend:
+    """LLMGateway用のバックエンド。生成はワーカープロセスで行う。
+
+    プロセスをまたいで少しずつ受け取ることはしないので、stream は生成し終わった全文を1回で返す。
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def generate(self, model, contents, usage=None):
+        text, call_usage = await self.pool.submit(_job_generate, model, contents, LLM_TIMEOUT)
+        if usage is not None: usage.update(call_usage)
+        return text
+
+    async def stream(self, model, contents, usage=None):
+        yield await self.generate(model, contents, usage)
+
+class ProcessSearcher:
+    """WebSearcher と同じ使い方で、検索と並べ替えをワーカープロセスで行う。"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.timeouts = 0
+
+    async def search_ranked(self, query, max_results, top_k):
+        results, complete, timeouts = await self.pool.submit(_job_search, query, max_results, top_k)
+        # 子プロセスの累計値なので、大きい方を残す (プロセスが複数ならおおよその値)
+        self.timeouts = max(self.timeouts, timeouts)
+        return results, complete
+
+    def shutdown(self):
+        # プールはBot全体で共有しているので、ここでは止めない
+        pass
+
+_pool = None
+
+def get_worker_pool():
+    """AI_WORKER_PROCESSES が1以上のときだけプールを作る。0なら None。"""
+    global _pool
+    if _pool is None and AI_WORKER_PROCESSES > 0:
+        _pool = WorkerPool(AI_WORKER_PROCESSES)
+    return _pool